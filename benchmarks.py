@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+"""Benchmarks for the nosedep plugin
+
+Run with `python benchmarks.py`. The micro benchmarks print one line per
+problem size so that scaling behaviour is easy to spot.
+
+The synthetic benchmarks generate test trees of nested packages with
+function or class based tests whose dependencies form chains, diamonds,
+a wide fan-out or a random mix with priorities. For each tree they measure
+the collection time, the time to compute the plan, the overhead per test
+of a run with the plugin compared to one without it, and the memory of the
+plugin itself: what the code of nosedep still holds after collection and the
+peak while computing the plan, both traced with tracemalloc (Python 3 only).
+The memory is measured in a second process, as tracing slows down the timed
+parts. Every case runs in its own process so that the registry and the memory
+of one case do not affect the next. The runs with and without the plugin are
+repeated in alternating order and the fastest of each are compared.
+
+    python benchmarks.py --sizes 1000,100000 --shapes chain,fanout
+    python benchmarks.py --compare ../nose-dep-master --json results.json
+
+With --compare each case is also run with the nosedep module of another
+checkout, and both are shown side by side. Nothing is downloaded.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import unittest
+
+import nose
+from nose.config import Config
+
+import nosedep
+from nosedep import DepLoader, NoseDep
+
+try:
+    import tracemalloc
+except ImportError:
+    # For python 2.7
+    tracemalloc = None
+
+
+def bench_dependency_checks(sizes=(1000, 10000, 40000), deps=5, repeat=2000):
+    """Cost of the beforeTest dependency checks as the number of results grows"""
+    target = 'bench_target'
+    prerequisites = ['bench_{}'.format(i) for i in range(deps)]
+    nosedep.dependencies[target] = set(prerequisites)
+    nosedep.invalidate_plan()
+    try:
+        for size in sizes:
+            plugin = NoseDep()
+            plugin.results = unittest.TestResult()
+            for i in range(size):
+                name = 'bench_{}'.format(i)
+                if i % 10 == 9:
+                    plugin.addFailure(name, None)
+                elif i % 10 == 8:
+                    plugin.addError(name, (Exception, None, None))
+                else:
+                    plugin.addSuccess(name)
+
+            def check():
+                plugin.dependency_failed(target)
+                plugin.dependency_ran(target)
+            elapsed = min(timeit.repeat(check, number=repeat, repeat=3))
+            print("dependency checks  results={:>6}  {:8.2f} us/test".format(
+                size, elapsed / repeat * 1e6))
+    finally:
+        del nosedep.dependencies[target]
+        nosedep.invalidate_plan()
+
+
+def bench_collection(sizes=(10, 100, 200)):
+    """Collection time when N tests of the same module are named"""
+    directory = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            module = 'bench_collection_{}'.format(size)
+            file_name = os.path.join(directory, module + '.py')
+            with open(file_name, 'w') as f:
+                for i in range(size):
+                    f.write('def test_{}():\n    pass\n\n\n'.format(i))
+            names = ['{}:test_{}'.format(file_name, i) for i in range(size)]
+
+            def one_by_one():
+                loader = DepLoader(Config(), workingDir=directory)
+                return [loader.loadTestsFromName(n) for n in names]
+
+            def batched():
+                return DepLoader(Config(), workingDir=directory).loadTestsFromNames(names)
+
+            for label, load in (('one by one', one_by_one), ('batched', batched)):
+                elapsed = min(timeit.repeat(load, number=1, repeat=3))
+                print("collection {:10}  names={:>4}  {:8.2f} ms".format(label, size,
+                                                                         elapsed * 1e3))
+            sys.modules.pop(module, None)
+    finally:
+        shutil.rmtree(directory)
+
+
+# Synthetic test trees
+
+shapes = ('chain', 'diamond', 'fanout', 'mixed')
+layouts = ('functions', 'classes')
+tests_per_module = 100
+modules_per_package = 10
+tests_per_class = 10
+
+
+def declaration(shape, i, start, end):
+    """The depends arguments of test i in the block of tests start to end
+
+    Tests only depend on tests of the same block, which is the whole tree for
+    function based tests and the class for class based ones. All edges go
+    from a lower to a higher index, so there are no cycles.
+    """
+    b = i - start
+    if shape == 'chain':
+        return {'after': [i - 1]} if b else {}
+    if shape == 'diamond':
+        top = i - b % 4
+        return [{}, {'after': [top]}, {'after': [top]}, {'after': [top + 1, top + 2]}][b % 4]
+    if shape == 'fanout':
+        return {'after': [start]} if b else {}
+    rng = random.Random(i)
+    args = {'priority': rng.choice((10, 50, 50, 90))}
+    if b and rng.random() < 0.5:
+        args['after'] = [rng.randrange(max(start, i - 10), i)]
+    if i + 1 < end and rng.random() < 0.2:
+        args['before'] = [rng.randrange(i + 1, min(end, i + 10))]
+    return args
+
+
+def depends_line(args, indent):
+    if not args:
+        return ''
+    parts = []
+    for key in ('after', 'before'):
+        if key in args:
+            parts.append("{}=[{}]".format(key, ', '.join("'test_{}'".format(d) for d in args[key])))
+    if 'priority' in args:
+        parts.append('priority={}'.format(args['priority']))
+    return '{}@depends({})\n'.format(indent, ', '.join(parts))
+
+
+def generate_tree(directory, size, shape, layout):
+    """Write `size` tests in packages of modules below directory"""
+    for first in range(0, size, tests_per_module):
+        module = first // tests_per_module
+        package = os.path.join(directory, 'pkg_{}'.format(module // modules_per_package ** 2),
+                               'sub_{}'.format(module // modules_per_package))
+        if not os.path.isdir(package):
+            os.makedirs(package)
+            for path in (package, os.path.dirname(package)):
+                open(os.path.join(path, '__init__.py'), 'a').close()
+        lines = ['from nosedep import depends\n\n']
+        for i in range(first, min(first + tests_per_module, size)):
+            if layout == 'functions':
+                lines.append('\n{}def test_{}():\n    pass\n\n'.format(
+                    depends_line(declaration(shape, i, 0, size), ''), i))
+                continue
+            start = i - i % tests_per_class
+            if i == start:
+                lines.append('\nclass TestC{}(object):\n'.format(i))
+            lines.append('{}    def test_{}(self):\n        pass\n\n'.format(
+                depends_line(declaration(shape, i, start, min(start + tests_per_class, size)),
+                             '    '), i))
+        with open(os.path.join(package, 'test_mod_{}.py'.format(module)), 'w') as f:
+            f.writelines(lines)
+
+
+def count_tests(suite):
+    if isinstance(suite, unittest.TestSuite):
+        return sum(count_tests(t) for t in suite)
+    return 1
+
+
+def plugin_memory(tree):
+    """Memory of the plugin in MB for collecting and planning tree
+
+    The memory allocated by the code of nosedep and still held after the
+    collection, which leaves out the test modules themselves, and the peak
+    while computing the plan. None if tracemalloc is not available.
+    """
+    if tracemalloc is None:
+        return None, None
+    tracemalloc.start()
+    try:
+        count_tests(DepLoader(Config(), workingDir=tree).loadTestsFromNames([tree]))
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(True, nosedep.__file__)])
+        collect = sum(stat.size for stat in snapshot.statistics('filename'))
+    finally:
+        tracemalloc.stop()
+    # Restarting forgets the collection, so the peak is the one of planning
+    tracemalloc.start()
+    try:
+        NoseDep.calculate_dependencies()
+        plan = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return collect / 2.0 ** 20, plan / 2.0 ** 20
+
+
+def timed_run(directory, plugins):
+    argv = ['nosetests', '-q', directory] + (['--with-nosedep'] if plugins else [])
+    stderr, sys.stderr = sys.stderr, open(os.devnull, 'w')
+    try:
+        start = time.time()
+        nose.run(argv=argv, addplugins=plugins)
+        return time.time() - start
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+
+# Runs of each tree with and without the plugin
+run_repeats = 3
+
+
+def run_case(shape, layout, size, memory=False):
+    """Measure one synthetic tree, to be called in a fresh process
+
+    With memory only the memory of the plugin is measured.
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        tree = os.path.join(directory, 'tree')
+        generate_tree(tree, size, shape, layout)
+        sys.path.insert(0, tree)
+        if memory:
+            collect, plan = plugin_memory(tree)
+            return {'collect_memory': collect, 'plan_memory': plan}
+        start = time.time()
+        loaded = count_tests(DepLoader(Config(), workingDir=tree).loadTestsFromNames([tree]))
+        collect = time.time() - start
+        start = time.time()
+        NoseDep.calculate_dependencies()
+        plan = time.time() - start
+        # An untimed run first, so that all timed runs find the modules imported
+        timed_run(tree, [])
+        without, with_plugin = [], []
+        for k in range(run_repeats):
+            runs = [(without, False), (with_plugin, True)]
+            for times, plugin in runs if k % 2 else reversed(runs):
+                times.append(timed_run(tree, [NoseDep()] if plugin else []))
+        return {'tests': loaded, 'collect': collect, 'plan': plan,
+                'overhead': (min(with_plugin) - min(without)) / size}
+    finally:
+        shutil.rmtree(directory)
+
+
+def spawn_case(case, checkout=None):
+    """Run a case in new processes, importing nosedep from checkout if given"""
+    checkout = os.path.abspath(checkout or os.path.dirname(os.path.abspath(__file__)))
+    result = {}
+    for extra in ([], ['--memory']):
+        script = ("import runpy, sys; sys.path.insert(0, {!r}); sys.argv = {!r}; "
+                  "runpy.run_path({!r}, run_name='__main__')").format(
+            checkout, [__file__, '--case', case] + extra, os.path.abspath(__file__))
+        output = subprocess.check_output([sys.executable, '-c', script])
+        result.update(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+    return result
+
+
+def megabytes(value):
+    return '    ?' if value is None else '{:5.1f}'.format(value)
+
+
+def describe(result):
+    return ("collect {:7.2f} s  plan {:7.3f} s  overhead {:7.1f} us/test  "
+            "memory collect {} MB  plan {} MB".format(
+                result['collect'], result['plan'], result['overhead'] * 1e6,
+                megabytes(result['collect_memory']), megabytes(result['plan_memory'])))
+
+
+def change(old, new):
+    if old is None or new is None or not old:
+        return '     ?'
+    return '{:+5.0f}%'.format((new - old) / abs(old) * 100)
+
+
+def bench_synthetic(sizes, case_shapes, case_layouts, compare=None):
+    """Run all cases, each in a process of its own, and return the results"""
+    results = []
+    for layout in case_layouts:
+        for shape in case_shapes:
+            for size in sizes:
+                case = '{},{},{}'.format(shape, layout, size)
+                label = "synthetic {:8} {:9} tests={:>6}".format(shape, layout, size)
+                result = {'case': case, 'this': spawn_case(case)}
+                if compare is None:
+                    print('{}  {}'.format(label, describe(result['this'])))
+                else:
+                    result['other'] = spawn_case(case, compare)
+                    this, other = result['this'], result['other']
+                    print(label)
+                    print('  {:14}  {}'.format('other checkout', describe(other)))
+                    print('  {:14}  {}'.format('this checkout', describe(this)))
+                    changes = [change(other[k], this[k])
+                               for k in ('collect', 'plan', 'overhead',
+                                         'collect_memory', 'plan_memory')]
+                    print('  {:14}  collect {}    plan {}    overhead {}          '
+                          'memory collect {}   plan {}'.format('change', *changes))
+                results.append(result)
+    return results
+
+
+def comma_list(kind):
+    return lambda value: [kind(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the nosedep plugin')
+    parser.add_argument('--sizes', type=comma_list(int), default=[1000, 10000],
+                        help='Number of tests of the synthetic trees (default 1000,10000)')
+    parser.add_argument('--shapes', type=comma_list(str), default=list(shapes),
+                        help='Dependency shapes, any of ' + ','.join(shapes))
+    parser.add_argument('--layouts', type=comma_list(str), default=list(layouts),
+                        help='Test layouts, any of ' + ','.join(layouts))
+    parser.add_argument('--compare', metavar='CHECKOUT',
+                        help='Also run the synthetic cases with the nosedep of CHECKOUT')
+    parser.add_argument('--json', metavar='FILE', help='Write the synthetic results to FILE')
+    parser.add_argument('--no-micro', action='store_true', help='Skip the micro benchmarks')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--memory', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.case:
+        shape, layout, size = args.case.split(',')
+        print(json.dumps(run_case(shape, layout, int(size), args.memory)))
+        return
+    if not args.no_micro:
+        bench_dependency_checks()
+        bench_collection()
+    results = bench_synthetic(args.sizes, args.shapes, args.layouts, args.compare)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
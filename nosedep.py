@@ -16,6 +16,8 @@ other specific test(s).
 There is also support for skipping tests based on the dependency results,
 thus if test B depends on test A and test A fails then B will be skipped
 with the reason that A failed.
+When all tests of a class or module are skipped this way its fixtures, like
+setUpClass or setup_module, are not run at all.
 
 Nosedep also supports running the necessary dependencies for a single test,
 thus if you specify to run only test B and test B depends on A; then A will
@@ -56,75 +58,789 @@ precedence so in total the ordering will be:
    dependency chain ordered first by priority then by name.
 
 Default priority if not specified is 50.
+
+Within the dependency chains a test waits for all tests of the previous group,
+even the unrelated ones. With ``--nosedep-order=heap`` each test instead runs as soon
+as its dependencies have run, picking the lowest priority first among the tests
+that are ready.
+
+With ``--nosedep-durations=FILE`` the time each test takes is recorded in FILE.
+``--nosedep-order=duration`` uses these times (from ``.nosedep-durations`` unless
+another file is given) to run the tests of a group with the same priority longest
+chain first, and the tests outside of dependency chains longest first. This
+shortens parallel runs, and brings the long chains to an end early.
+
+Independent tests can run in parallel with ``--nosedep-workers=N``. The tests are
+grouped in dependency levels and each level runs in N forked worker processes,
+so 'after' dependencies are still honoured and dependents are still skipped
+when a required test fails in another worker. Suites with fixtures always run
+as a whole in a single worker. This requires a platform that supports fork.
+
+Nosedep also works together with nose's multiprocess plugin (``--processes=N``).
+Tests connected by dependencies are then sent as one group to a single worker
+process, which runs them in dependency order, while unrelated tests are spread
+over the other workers.
+
+When an expensive test builds state that many tests read, like a large data set
+loaded into memory, ``--nosedep-fork=N`` runs the tests in the main process until
+such a test passes. If independent chains of tests depend on it with 'after',
+up to N processes are forked right then and run the chains, sharing the state
+copy-on-write instead of building it again. Their outcomes are reported as each
+chain is done. This requires a platform that supports fork, elsewhere the chains
+run one after the other.
+
+Tests that mostly wait for I/O, and share clients or other state of the process,
+can run in threads with ``--nosedep-threads=N``. Each test starts in one of N
+threads as soon as the tests it depends on are done, and its output is shown
+when it is done. The tests of a class or module with fixtures all run in the
+same thread. The hooks of other plugins are called from the threads, so output
+captured for a failed test may include output of tests running at the same time.
+
+Tests that must not overlap when they run in parallel can declare what they use
+with ``resources``::
+
+    @depends(after='test_setup', resources=['db', 'mem:4G'])
+    def test_query():
+      pass
+
+By default a resource is used by one test at a time. How much there is of a
+resource is given with ``--nosedep-resources=mem:16G,db:2``. With
+``--nosedep-workers``, ``--nosedep-threads`` and ``--nosedep-fork`` tests are started as
+early as their resources allow, and the time each test waited for them is shown
+after the run.
+
+Coroutine functions can be decorated with ``depends`` too, and each then runs on
+an event loop of its own. With ``--nosedep-async=N`` the coroutine tests that are
+ready, because the tests they depend on are done, instead run concurrently on a
+single event loop, up to N at a time. The outcome of each is reported when it
+completes, so the tests that depend on it start right away. Other tests, and
+coroutine tests in classes or with fixtures, run as usual in between. This
+requires Python 3, and can not be combined with ``--nosedep-workers``,
+``--nosedep-fork`` or ``--nosedep-threads``.
+
+By default running a specific test loads the whole file or directory it was
+given with, and dependencies declared in other files are not found. With
+``--nosedep-index=FILE`` the ``@depends`` declarations of all files in the working
+directory are found by parsing them, without importing anything, and stored in
+FILE. Like nose, only packages and directories that look like tests are
+searched. Files are parsed again only when they change. A run of specific tests
+then loads only the files that hold the tests and their 'after' dependencies.
+
+Very large dependency graphs are ordered with NumPy if it is installed.
+
+With ``--nosedep-failed`` the outcomes of each run are stored (in ``.nosedep-results``
+unless ``--nosedep-results=FILE`` is given) and the next run with the option only
+runs the tests that failed, errored or were skipped because of a dependency,
+together with the tests they depend on with 'after'. When there are no such
+tests everything runs. Such tests that are not collected, for instance since their
+module is not given this time, are listed. If none of them is collected the run
+fails instead of passing without running anything.
+
+With ``--nosedep-cache=FILE`` the outcomes are also cached together with a hash of
+the source of each test and of the tests it depends on. When specific tests are
+run, the tests they depend on are not run again if they passed before and none
+of that source changed. ``--nosedep-cache-force`` runs them anyway.
+
+Long runs can be continued after they were interrupted. With
+``--nosedep-journal=FILE`` the outcome of each test is logged to FILE as soon as it is
+known, and adding ``--nosedep-resume`` to the same command continues the run: the
+logged outcomes are restored and only the tests without an outcome run. Tests that
+failed before the interruption are reported again and still fail the run.
+
+A run can be split over several CI nodes with ``--nosedep-shard=K/N``, where each
+node runs shard K of N. Every shard holds the tests that its tests depend on with
+'after', so a test that several shards need runs in each of them. The shards are
+balanced by the number of tests, so that every node computes the same split. With
+``--nosedep-durations=FILE`` they are balanced with the times in FILE instead,
+which must then be the same file on every node, for instance one kept as a CI
+artifact, since each node records its own times in it after its run.
+
+The resolved plan, that is the order of the tests, the tests selected to run and
+the shard, can be stored with ``--nosedep-plan-out=FILE`` and used by later runs
+with ``--nosedep-plan-in=FILE`` instead of working it out again. The plan is only
+used if it was made with the same options from the same test files. Files with
+another modification time or size are compared by their content, so a plan can
+be made once and copied to other checkouts. Only resolving the dependencies is
+skipped: the tests are still collected, which imports the test files, and the
+suites are still put in the stored order.
+
+Nose's ``--collect-only`` lists the tests in nose's own order. To see the order
+nosedep will run them in use ``--nosedep-preview``, which collects and orders the
+tests like a real run, including the selection and the shard, but runs nothing.
+Each test is listed with its dependency level, its priority and why it is
+included: collected, requested on the command line or a dependency of another
+test.
+
+To find out how much time the plugin itself takes, ``--nosedep-profile=FILE`` times
+its hooks and writes the number of calls, the total time and a latency histogram
+of each to FILE as JSON when the run ends. The same numbers are available as
+``plugin.profile.stats()`` for code that runs nose with a ``NoseDep`` instance.
+Hooks that run in the worker processes of ``--processes`` are not included.
+
+Each run of a few tests pays again for starting Python, importing nose and the
+test modules and planning the dependencies. ``python -m nosedep_daemon serve``
+starts a daemon that keeps all of that in memory for the working directory,
+and ``python -m nosedep_daemon run`` followed by the usual nosetests arguments
+runs the tests in it, with the same output and exit code as nosetests. Before
+each run the modules whose files changed are loaded again, and the plan is only
+worked out again when what they declare with ``depends`` changed. Other state of
+the test modules is kept between runs. Without a daemon the tests run in the
+calling process. ``python -m nosedep_daemon stop`` stops the daemon. This
+requires Unix sockets.
 """
+import ast
+import hashlib
+import heapq
 import imp
 import inspect
+import json
 import os
 import re
+import sys
+import threading
+import time
+import unittest
+from array import array
 from collections import defaultdict
 from functools import partial, wraps
 from itertools import chain, tee
 
+from nose.case import FunctionTestCase, MethodTestCase, Test
+from nose.config import Config
+from nose.importer import Importer
 from nose.loader import TestLoader
 from nose.plugins import Plugin
-from nose.suite import ContextSuite
+from nose.plugins.skip import SkipTest
+from nose.suite import ContextSuite, LazySuite
+from nose.util import getpackage
 try:
     # Older versions of setuptools
     from setuptools.compat import reraise
 except ImportError:
     from setuptools.extern.six import reraise
-from toposort import toposort
+try:
+    from collections.abc import MutableMapping, MutableSet
+except ImportError:
+    from collections import MutableMapping, MutableSet
 
-dependencies = defaultdict(set)
-soft_dependencies = defaultdict(set)
-default_priority = 50
-priorities = defaultdict(lambda: default_priority)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+HARD = 0
+SOFT = 1
+# Graphs with at least this many edges are leveled with NumPy when it is
+# installed. Below it the pure Python loop is faster than the conversions.
+numpy_threshold = 100000
+numpy_level_width = 256
+
+
+class CircularDependencyError(ValueError):
+    def __init__(self, data):
+        s = 'Circular dependencies exist among these items: {{{}}}'.format(
+            ', '.join('{!r}:{!r}'.format(k, v) for k, v in sorted(data.items())))
+        super(CircularDependencyError, self).__init__(s)
+        self.data = data
+
+
+class DependencyGraph(object):
+    """Storage for the dependency registry
 
+    Test names are interned to consecutive integer ids. The 'after' (HARD)
+    and 'before' (SOFT) edges of each test are kept as arrays of the ids of
+    the tests that have to run before it, and priorities in an array indexed
+    by id. `dependencies`, `soft_dependencies` and `priorities` are name based
+    views on top of this.
 
-def depends(func=None, after=None, before=None, priority=None):
+    For leveling the edges of both kinds are packed into CSR form: the
+    successors of test `i` are `targets[offsets[i]:offsets[i + 1]]`.
+
+    While edges are added the arrays they go into are mirrored by sets in
+    `members`, so that adding an edge does not have to scan the prerequisites
+    already registered. csr() drops the sets, as the edges are not changed
+    once the plan is made, and they are only built again for further edges.
+    """
+
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.ids = {}
+        self.names = []
+        self.edges = ([], [])
+        self.members = {}
+        self.priority = array('i')
+        self.has_priority = array('b')
+
+    def changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def clear(self):
+        self.ids = {}
+        self.names = []
+        self.edges = ([], [])
+        self.members = {}
+        self.priority = array('i')
+        self.has_priority = array('b')
+        self.changed()
+
+    def intern(self, name):
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+            self.edges[HARD].append(None)
+            self.edges[SOFT].append(None)
+            self.priority.append(0)
+            self.has_priority.append(0)
+        return i
+
+    def adjacency(self, kind, name, create=False):
+        """The array of prerequisite ids of `name`, None if there are none"""
+        i = self.intern(name) if create else self.ids.get(name)
+        if i is None:
+            return None
+        edges = self.edges[kind]
+        if create and edges[i] is None:
+            edges[i] = array('i')
+        return edges[i]
+
+    def has_edge(self, kind, name, prerequisite):
+        i, p = self.ids.get(name), self.ids.get(prerequisite)
+        if i is None or p is None:
+            return False
+        members = self.members.get((kind, i))
+        if members is not None:
+            return p in members
+        ids = self.edges[kind][i]
+        return bool(ids) and p in ids
+
+    def add_edge(self, kind, name, prerequisite):
+        """Make `prerequisite` a prerequisite of `name`, False if it already was"""
+        ids = self.adjacency(kind, name, create=True)
+        key = kind, self.ids[name]
+        members = self.members.get(key)
+        if members is None:
+            members = self.members[key] = set(ids)
+        i = self.intern(prerequisite)
+        if i in members:
+            return False
+        members.add(i)
+        ids.append(i)
+        return True
+
+    def discard_edge(self, kind, name, prerequisite):
+        """Remove `prerequisite` from the prerequisites of `name`, False if it was not one"""
+        if not self.has_edge(kind, name, prerequisite):
+            return False
+        i = self.ids[prerequisite]
+        self.members.get((kind, self.ids[name]), set()).discard(i)
+        self.adjacency(kind, name).remove(i)
+        return True
+
+    def clear_edges(self, kind, name):
+        ids = self.adjacency(kind, name)
+        if ids:
+            del ids[:]
+            self.members.pop((kind, self.ids[name]), None)
+
+    def csr(self):
+        """Pack all edges into (offsets, targets, indegree, active)
+
+        Edges point from a prerequisite to the tests that depend on it. Self
+        dependencies are dropped. `active` flags the tests that have at least
+        one edge, which are the tests that take part in the plan.
+        """
+        self.members = {}
+        n = len(self.names)
+        sources, dependents = array('i'), array('i')
+        for edges in self.edges:
+            for i, prerequisites in enumerate(edges):
+                if prerequisites:
+                    sources.extend(prerequisites)
+                    dependents.extend(array('i', [i]) * len(prerequisites))
+        if numpy is not None and len(sources) >= numpy_threshold:
+            return numpy_csr(n, sources, dependents)
+        offsets = array('i', [0]) * (n + 1)
+        indegree = array('i', [0]) * n
+        active = array('b', [0]) * n
+        for p, i in zip(sources, dependents):
+            if p != i:
+                offsets[p + 1] += 1
+                indegree[i] += 1
+                active[i] = active[p] = 1
+        for i in range(n):
+            offsets[i + 1] += offsets[i]
+        targets = array('i', [0]) * offsets[n]
+        fill = offsets[:n]
+        for p, i in zip(sources, dependents):
+            if p != i:
+                targets[fill[p]] = i
+                fill[p] += 1
+        return offsets, targets, indegree, active
+
+    def levels(self):
+        """Yield lists of ids; each list only depends on the ones before it
+
+        Kahn's algorithm on the CSR arrays, so that it is linear in the
+        size of the graph.
+        """
+        offsets, targets, indegree, active = self.csr()
+        if numpy is not None and isinstance(targets, numpy.ndarray):
+            levels = numpy_levels(offsets, targets, indegree, active)
+            # Summing the int8 flags one by one would wrap around
+            active_count = int(numpy.count_nonzero(active))
+        else:
+            levels = python_levels(offsets, targets, indegree, active)
+            active_count = sum(active)
+        done = set()
+        for level in levels:
+            done.update(level)
+            yield level
+        if len(done) < active_count:
+            names = self.names
+            raise CircularDependencyError(dict(
+                (names[i], set(names[p] for edges in self.edges for p in edges[i] or ()
+                               if p not in done and p != i))
+                for i in range(len(names)) if active[i] and i not in done))
+
+    def priority_of(self, i):
+        return self.priority[i] if self.has_priority[i] else default_priority
+
+    def sorted_levels(self, key=None):
+        """Levels of names, each ordered by priority and then name
+
+        :param key: Sort key for the names of a level instead.
+        """
+        names = self.names
+        for level in self.levels():
+            if key is None:
+                level = sorted(level, key=lambda i: (self.priority_of(i), names[i]))
+                yield [names[i] for i in level]
+            else:
+                yield sorted((names[i] for i in level), key=key)
+
+    def critical_paths(self, durations):
+        """For each test the time from its start to the end of its longest chain
+
+        That is its own duration plus the longest critical path of the tests
+        depending on it. Tests without a known duration are assumed to take
+        the average time.
+        """
+        offsets, targets = [a.tolist() for a in self.csr()[:2]]
+        names = self.names
+        known = [durations[n] for n in names if n in durations]
+        default = sum(known) / len(known) if known else 0.0
+        paths = {}
+        for level in reversed(list(self.levels())):
+            for i in level:
+                longest = max([paths[t] for t in targets[offsets[i]:offsets[i + 1]]] or [0.0])
+                paths[i] = durations.get(names[i], default) + longest
+        return dict((names[i], p) for i, p in paths.items())
+
+
+def python_levels(offsets, targets, indegree, active):
+    indegree = indegree[:]
+    level = [i for i in range(len(indegree)) if active[i] and not indegree[i]]
+    while level:
+        yield level
+        following = []
+        for i in level:
+            for k in range(offsets[i], offsets[i + 1]):
+                t = targets[k]
+                indegree[t] -= 1
+                if not indegree[t]:
+                    following.append(t)
+        level = following
+
+
+def numpy_csr(n, sources, dependents):
+    """DependencyGraph.csr for the flat edge arrays, as NumPy arrays"""
+    sources = numpy.frombuffer(sources, dtype=numpy.intc)
+    dependents = numpy.frombuffer(dependents, dtype=numpy.intc)
+    keep = sources != dependents
+    sources, dependents = sources[keep], dependents[keep]
+    offsets = numpy.zeros(n + 1, dtype=numpy.intc)
+    numpy.cumsum(numpy.bincount(sources, minlength=n), out=offsets[1:])
+    targets = dependents[numpy.argsort(sources, kind='mergesort')]
+    indegree = numpy.bincount(dependents, minlength=n).astype(numpy.intc)
+    active = numpy.zeros(n, dtype=numpy.int8)
+    active[sources] = 1
+    active[dependents] = 1
+    return offsets, targets, indegree, active
+
+
+def numpy_levels(offsets, targets, indegree, active):
+    """python_levels processing each wide level with a few NumPy operations
+
+    Levels narrower than numpy_level_width are cheaper to walk one edge at a
+    time, which keeps deep chains from paying the per call overhead.
+    """
+    indegree = indegree.copy()
+    offsets_list, targets_list = offsets.tolist(), targets.tolist()
+    level = numpy.flatnonzero(active & (indegree == 0)).tolist()
+    while level:
+        yield level
+        if len(level) < numpy_level_width:
+            following = []
+            for i in level:
+                for t in targets_list[offsets_list[i]:offsets_list[i + 1]]:
+                    indegree[t] -= 1
+                    if not indegree[t]:
+                        following.append(t)
+            level = following
+            continue
+        level = numpy.array(level, dtype=numpy.intc)
+        starts = offsets[level]
+        lengths = offsets[level + 1] - starts
+        total = lengths.sum()
+        if not total:
+            break
+        # Positions of all successors of the level in targets
+        shift = numpy.repeat(starts - (numpy.cumsum(lengths) - lengths), lengths)
+        successors = targets[shift + numpy.arange(total)]
+        numpy.subtract.at(indegree, successors, 1)
+        successors = numpy.unique(successors)
+        level = successors[indegree[successors] == 0].tolist()
+
+
+class HeapScheduler(object):
+    """Release tests as soon as everything they depend on is done
+
+    Unlike the levels a test does not wait for unrelated tests that happen
+    to be in an earlier level; of all the tests that are ready the one with
+    the lowest (priority, name) is always next. Iterating gives a complete
+    order in O((V + E) log V), marking each test done before the next one is
+    taken. While a run is in progress `pop` and `done` can be used instead,
+    so that dependents are only released once a test has actually finished::
+
+        scheduler = HeapScheduler(registry)
+        test = scheduler.pop()
+        while test is not None:
+            run(test)
+            scheduler.done(test)
+            test = scheduler.pop()
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        offsets, targets, indegree, active = graph.csr()
+        self.offsets = offsets.tolist()
+        self.targets = targets.tolist()
+        self.indegree = indegree.tolist()
+        self.remaining = sum(active.tolist())
+        self.heap = [self.key(i) for i, flag in enumerate(active.tolist())
+                     if flag and not self.indegree[i]]
+        heapq.heapify(self.heap)
+
+    def key(self, i):
+        return self.graph.priority_of(i), self.graph.names[i], i
+
+    def ready(self):
+        """The tests that can run now, in the order pop returns them"""
+        return [name for _, name, _ in sorted(self.heap)]
+
+    def pop(self):
+        """Take the next test that is ready, None if there is none"""
+        if not self.heap:
+            return None
+        return heapq.heappop(self.heap)[1]
+
+    def done(self, name):
+        """Mark a test taken with pop as done, releasing its dependents"""
+        i = self.graph.ids[name]
+        self.remaining -= 1
+        for k in range(self.offsets[i], self.offsets[i + 1]):
+            t = self.targets[k]
+            self.indegree[t] -= 1
+            if not self.indegree[t]:
+                heapq.heappush(self.heap, self.key(t))
+
+    def __iter__(self):
+        name = self.pop()
+        while name is not None:
+            yield name
+            self.done(name)
+            name = self.pop()
+        if self.remaining:
+            names = self.graph.names
+            raise CircularDependencyError(dict(
+                (names[i], set(names[p] for edges in self.graph.edges for p in edges[i] or ()
+                               if self.indegree[p] and p != i))
+                for i, degree in enumerate(self.indegree) if degree))
+
+
+def toposort_levels(data):
+    """Levels of a {node: prerequisites} dict, as toposort.toposort gives them"""
+    graph = DependencyGraph()
+    edges = Edges(graph, HARD)
+    for node, prerequisites in data.items():
+        graph.intern(node)
+        edges[node] = prerequisites
+    levels = [set(graph.names[i] for i in level) for level in graph.levels()]
+    # Nodes without any edges are not part of the graph levels
+    isolated = set(graph.names).difference(*levels)
+    if isolated:
+        if levels:
+            levels[0] |= isolated
+        else:
+            levels.append(isolated)
+    return levels
+
+
+class Prerequisites(MutableSet):
+    """Name based view on the prerequisites of one test"""
+
+    def __init__(self, graph, kind, name):
+        self.graph = graph
+        self.kind = kind
+        self.name = name
+
+    def _ids(self):
+        return self.graph.adjacency(self.kind, self.name) or ()
+
+    def __contains__(self, name):
+        return self.graph.has_edge(self.kind, self.name, name)
+
+    def __iter__(self):
+        names = self.graph.names
+        return iter([names[i] for i in self._ids()])
+
+    def __len__(self):
+        return len(self._ids())
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, set(self))
+
+    def add(self, name):
+        if self.graph.add_edge(self.kind, self.name, name):
+            self.graph.changed()
+
+    def discard(self, name):
+        if self.graph.discard_edge(self.kind, self.name, name):
+            self.graph.changed()
+
+    def update(self, *others):
+        for name in chain(*others):
+            self.add(name)
+
+
+class Edges(MutableMapping):
+    """Name based view on one kind of edges, like a defaultdict(set)
+
+    Indexing a test returns a live set-like view on its prerequisites. A test
+    is only contained in the mapping while it has at least one of them.
+    """
+
+    def __init__(self, graph, kind):
+        self.graph = graph
+        self.kind = kind
+
+    def __getitem__(self, name):
+        return Prerequisites(self.graph, self.kind, name)
+
+    def __setitem__(self, name, value):
+        self.graph.clear_edges(self.kind, name)
+        self.graph.adjacency(self.kind, name, create=True)
+        for n in value:
+            self.graph.add_edge(self.kind, name, n)
+        self.graph.changed()
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.graph.clear_edges(self.kind, name)
+        self.graph.changed()
+
+    def __contains__(self, name):
+        return bool(self.graph.adjacency(self.kind, name))
+
+    def __iter__(self):
+        names = self.graph.names
+        return iter([names[i] for i, ids in enumerate(self.graph.edges[self.kind]) if ids])
+
+    def __len__(self):
+        return sum(1 for ids in self.graph.edges[self.kind] if ids)
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def pop(self, name, *default):
+        if name not in self:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        value = set(self[name])
+        del self[name]
+        return value
+
+
+class Priorities(MutableMapping):
+    """Name based view on the priorities; unset ones read as default_priority"""
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __getitem__(self, name):
+        i = self.graph.ids.get(name)
+        if i is None or not self.graph.has_priority[i]:
+            return default_priority
+        return self.graph.priority[i]
+
+    def __setitem__(self, name, value):
+        i = self.graph.intern(name)
+        if self.graph.has_priority[i] and self.graph.priority[i] == value:
+            return
+        self.graph.priority[i] = value
+        self.graph.has_priority[i] = 1
+        self.graph.changed()
+
+    def __delitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        self.graph.has_priority[self.graph.ids[name]] = 0
+        self.graph.changed()
+
+    def __contains__(self, name):
+        i = self.graph.ids.get(name)
+        return i is not None and bool(self.graph.has_priority[i])
+
+    def __iter__(self):
+        names = self.graph.names
+        return iter([names[i] for i, flag in enumerate(self.graph.has_priority) if flag])
+
+    def __len__(self):
+        return sum(self.graph.has_priority)
+
+
+registry = DependencyGraph(lambda: invalidate_plan())
+dependencies = Edges(registry, HARD)
+soft_dependencies = Edges(registry, SOFT)
+default_priority = 50
+priorities = Priorities(registry)
+# The resources each test holds while it runs, as given to depends
+resource_needs = {}
+# The (name, after, before, priority, resources) given to depends by each
+# module, so that the registry can be rebuilt when a module is reloaded
+declarations = defaultdict(list)
+
+# Test outcomes as stored in NoseDep.statuses. A test that is not in the
+# index has not run (yet).
+PASSED = 'PASSED'
+FAILED = 'FAILED'
+ERRORED = 'ERRORED'
+SKIPPED = 'SKIPPED'
+# If a test is reported more than once (a failing test with an erroring
+# tearDown for example) the most severe outcome is kept.
+status_rank = {PASSED: 0, SKIPPED: 1, ERRORED: 2, FAILED: 3}
+
+
+amount_units = {'': 1, 'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30, 'T': 2 ** 40}
+
+
+def parse_resources(specs):
+    """Turn resource specifications like ['db', 'mem:4G'] into {'db': 1, 'mem': 4 * 2 ** 30}"""
+    if type(specs) is not list:
+        specs = [specs]
+    needs = {}
+    for spec in specs:
+        name, _, amount = spec.strip().partition(':')
+        m = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', amount.strip() or '1', re.IGNORECASE)
+        if not name or not m:
+            raise ValueError("Invalid resource '{}', should be NAME or NAME:AMOUNT".format(spec))
+        needs[name] = float(m.group(1)) * amount_units[m.group(2).upper()]
+    return needs
+
+
+def depends(func=None, after=None, before=None, priority=None, resources=None):
     """Decorator to specify test dependencies
 
     :param after: The test needs to run after this/these tests. String or list of strings.
     :param before: The test needs to run before this/these tests. String or list of strings.
+    :param resources: What the test holds while it runs, like 'db' or 'mem:4G'. Tests
+                      running in parallel never hold more of a resource than there is.
+                      String or list of strings.
     """
     if not (func is None or inspect.ismethod(func) or inspect.isfunction(func)):
         raise ValueError("depends decorator can only be used on functions or methods")
-    if not (after or before or priority):
+    if not (after or before or priority or resources):
         raise ValueError("depends decorator needs at least one argument")
 
     # This avoids some nesting in the decorator
     # If called without func the decorator was called with optional args
     # so we'll return a function with those args filled in.
     if func is None:
-        return partial(depends, after=after, before=before, priority=priority)
-
-    def self_check(a, b):
-        if a == b:
-            raise ValueError("Test '{}' cannot depend on itself".format(a))
-
-    def handle_dep(conditions, _before=True):
-        if conditions:
-            if type(conditions) is not list:
-                conditions = [conditions]
-            for cond in conditions:
-                if hasattr(cond, '__call__'):
-                    cond = cond.__name__
-                self_check(func.__name__, cond)
-                if _before:
-                    soft_dependencies[cond].add(func.__name__)
-                else:
-                    dependencies[func.__name__].add(cond)
+        return partial(depends, after=after, before=before, priority=priority,
+                       resources=resources)
+
+    def names(conditions):
+        if not conditions:
+            return []
+        if type(conditions) is not list:
+            conditions = [conditions]
+        return [c.__name__ if hasattr(c, '__call__') else c for c in conditions]
+
+    declaration = (func.__name__, names(after), names(before), priority, resources)
+    register(*declaration)
+    declarations[func.__module__].append(declaration)
+
+    if is_coroutine_function(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            return run_coroutine(func(*args, **kwargs))
+        # Run on a shared event loop by --nosedep-async instead
+        inner.nosedep_coroutine = func
+    else:
+        @wraps(func)
+        def inner(*args, **kwargs):
+            return func(*args, **kwargs)
+    # Set by wraps on Python 3 only, the result cache needs the source of func
+    inner.__wrapped__ = func
+    return inner
 
-    handle_dep(before)
-    handle_dep(after, False)
+
+def register(name, after, before, priority, resources):
+    """Add what depends declared for the test `name` to the registry"""
+    for cond in after + before:
+        if cond == name:
+            raise ValueError("Test '{}' cannot depend on itself".format(name))
+    for cond in before:
+        soft_dependencies[cond].add(name)
+    for cond in after:
+        dependencies[name].add(cond)
 
     if priority:
-        priorities[func.__name__] = priority
+        priorities[name] = priority
+
+    if resources:
+        resource_needs[name] = parse_resources(resources)
+
+
+def rebuild_registry():
+    """Fill the registry again from the declarations of the loaded modules"""
+    registry.clear()
+    resource_needs.clear()
+    for module in list(declarations):
+        for declaration in declarations[module]:
+            register(*declaration)
 
-    @wraps(func)
-    def inner(*args, **kwargs):
-        return func(*args, **kwargs)
-    return inner
+
+def is_coroutine_function(func):
+    return asyncio is not None and asyncio.iscoroutinefunction(func)
+
+
+def run_coroutine(coroutine):
+    """Run a coroutine to completion on an event loop of its own"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
 
 
 def import_from_uri(uri, absl=True):
@@ -146,23 +862,410 @@ def import_from_uri(uri, absl=True):
     return None
 
 
-def has_class(file_name, class_name):
-    mod = import_from_uri(file_name)
-    if not mod:
+def imported_module(file_name):
+    """Return the module already imported from file_name, if any"""
+    no_ext = os.path.splitext(os.path.abspath(file_name))[0]
+    for mod in list(sys.modules.values()):
+        mod_file = getattr(mod, '__file__', None)
+        if mod_file and os.path.splitext(os.path.abspath(mod_file))[0] == no_ext:
+            return mod
+    return None
+
+
+def source_classes(file_name):
+    """Names of the classes and of the functions defined at module level in a source file"""
+    with open(file_name, 'rb') as f:
+        tree = ast.parse(f.read(), file_name)
+    function_types = tuple(getattr(ast, t) for t in ('FunctionDef', 'AsyncFunctionDef')
+                           if hasattr(ast, t))
+    classes, functions = set(), set()
+    nodes = list(tree.body)
+    while nodes:
+        node = nodes.pop()
+        if isinstance(node, ast.ClassDef):
+            classes.add(node.name)
+        elif isinstance(node, function_types):
+            functions.add(node.name)
+        else:
+            # Classes defined in if/try blocks are module level as well
+            nodes.extend(ast.iter_child_nodes(node))
+    return classes, functions
+
+
+_module_classes = {}
+
+
+def module_classes(file_name):
+    """Names of the classes and of the other members of a test file, computed once per file
+
+    Uses the module if it is already imported and otherwise parses the source,
+    so module level code is never executed just to answer this. Only when
+    there is no source the module is imported. From the source only functions
+    are known not to be classes, names bound otherwise may be either.
+    """
+    file_name = os.path.abspath(file_name)
+    if file_name not in _module_classes:
+        mod = imported_module(file_name)
+        source = os.path.splitext(file_name)[0] + '.py'
+        if mod is None and os.path.isfile(source):
+            try:
+                _module_classes[file_name] = source_classes(source)
+                return _module_classes[file_name]
+            except (SyntaxError, ValueError, IOError):
+                pass
+        if mod is None:
+            mod = import_from_uri(file_name)
+        members = inspect.getmembers(mod) if mod else []
+        _module_classes[file_name] = (set(n for n, m in members if inspect.isclass(m)),
+                                      set(n for n, m in members if not inspect.isclass(m)))
+    return _module_classes[file_name]
+
+
+def has_class(file_name, class_name, importer=None):
+    """True if class_name is a class in the test file
+
+    A name that is not defined in the file, like a class imported from another
+    module, is looked up in the module imported with nose's importer.
+    """
+    classes, others = module_classes(file_name)
+    if class_name in classes:
+        return True
+    if class_name in others or '.' in class_name:
         return False
-    return bool(inspect.getmembers(mod, lambda o: inspect.isclass(o) and o.__name__ == class_name))
+    file_name = os.path.abspath(file_name)
+    mod = imported_module(file_name)
+    if mod is None and os.path.isfile(file_name):
+        try:
+            mod = (importer or Importer()).importFromPath(file_name, getpackage(file_name))
+        except Exception:
+            # nose reports the error when it loads the file
+            return False
+    return inspect.isclass(getattr(mod, class_name, None))
+
+
+def is_within(file_name, path):
+    """True if file_name is path or is located somewhere below it"""
+    return file_name == path or file_name.startswith(path.rstrip(os.sep) + os.sep)
+
+
+def decorator_value(node):
+    """Statically evaluate an argument given to the depends decorator
+
+    Function references evaluate to their names like they do in `depends`.
+    Returns None for anything that can not be resolved without running code.
+    """
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [decorator_value(n) for n in node.elts]
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return None
+
+
+def parse_dependencies(file_name):
+    """Find the depends declarations of a test file without importing it
+
+    :return: Tuple of all function and method names defined in the file and
+             a dict with the after, before and priority arguments per
+             decorated test.
+    """
+    with open(file_name, 'rb') as f:
+        tree = ast.parse(f.read(), file_name)
+    defined = set()
+    declared = {}
+    function_types = tuple(getattr(ast, t) for t in ('FunctionDef', 'AsyncFunctionDef')
+                           if hasattr(ast, t))
+    for node in ast.walk(tree):
+        if not isinstance(node, function_types):
+            continue
+        defined.add(node.name)
+        for decorator in node.decorator_list:
+            if not isinstance(decorator, ast.Call):
+                continue
+            func = decorator.func
+            if getattr(func, 'id', getattr(func, 'attr', None)) != 'depends':
+                continue
+            args = dict((kw.arg, decorator_value(kw.value)) for kw in decorator.keywords)
+            declaration = {'priority': args.get('priority')}
+            for key in ('after', 'before'):
+                value = args.get(key) or []
+                declaration[key] = [v for v in (value if isinstance(value, list) else [value]) if v]
+            declared[node.name] = declaration
+    return sorted(defined), declared
+
+
+class JsonStore(object):
+    """A JSON object in a file, tagged with the version of its layout
+
+    `fields` are the keys the object has to hold. A file that is missing,
+    can not be read, is of another version or lacks one of the fields reads
+    as an empty dict, so the subclasses start from scratch.
+    """
+    version = 1
+    fields = ()
+    separators = None
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def load(self):
+        if not os.path.isfile(self.file_name):
+            return {}
+        try:
+            with open(self.file_name) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.version or \
+                not all(k in data for k in self.fields):
+            return {}
+        return data
+
+    def dump(self, **data):
+        data['version'] = self.version
+        with open(self.file_name, 'w') as f:
+            json.dump(data, f, separators=self.separators)
+        return data
+
+
+class DependencyIndex(JsonStore):
+    """Persistent index of the depends declarations in a source tree
+
+    The declarations are found by parsing the test files, so nothing has to be
+    imported to find out which files a test needs. The index is stored as JSON
+    and a file is only parsed again when its modification time or size changed.
+    """
+    fields = ('files',)
+
+    def __init__(self, index_file):
+        super(DependencyIndex, self).__init__(index_file)
+        self.files = self.load().get('files', {})
+        self.changed = False
+        self.defined = defaultdict(set)
+        self.after = defaultdict(set)
+
+    def update(self, root, test_match=None):
+        """Parse new and modified files below root and forget deleted ones
+
+        Like nose only packages and directories matching test_match, the
+        testMatch of nose by default, are entered. Virtualenvs and build
+        directories are not.
+        """
+        root = os.path.abspath(root)
+        test_match = test_match or Config().testMatch
+        seen = set()
+        for path, dirs, files in os.walk(root):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != '__pycache__' and (
+                test_match.search(d) or os.path.isfile(os.path.join(path, d, '__init__.py'))))
+            for f in sorted(files):
+                if not f.endswith('.py'):
+                    continue
+                file_name = os.path.join(path, f)
+                seen.add(file_name)
+                stat = os.stat(file_name)
+                entry = self.files.get(file_name)
+                if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                    continue
+                try:
+                    defined, declared = parse_dependencies(file_name)
+                except (SyntaxError, ValueError, IOError):
+                    defined, declared = [], {}
+                self.files[file_name] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                                         'defined': defined, 'tests': declared}
+                self.changed = True
+        for file_name in [f for f in self.files if is_within(f, root) and f not in seen]:
+            del self.files[file_name]
+            self.changed = True
+        self.build()
+        return self
+
+    def build(self):
+        self.defined.clear()
+        self.after.clear()
+        for file_name, entry in self.files.items():
+            for name in entry['defined']:
+                self.defined[name].add(file_name)
+            for name, declaration in entry['tests'].items():
+                self.after[name].update(declaration['after'])
+
+    def save(self):
+        if not self.changed:
+            return
+        self.dump(files=self.files)
+        self.changed = False
+
+    def hard_closure(self, name):
+        """The test and all tests it transitively depends on with 'after'"""
+        closure, stack = {name}, [name]
+        while stack:
+            for dep in self.after.get(stack.pop(), ()):
+                if dep not in closure:
+                    closure.add(dep)
+                    stack.append(dep)
+        return closure
+
+    def closure_files(self, name, path):
+        """Files needed to run test `name` found below `path`
+
+        That is the files defining the test and everything in its hard
+        dependency closure. Like with functions given to depends, a
+        prerequisite defined in the file that depends on it is taken from
+        that file. Otherwise it is preferably taken from below `path`.
+        Returns an empty list if the test is not indexed.
+        """
+        path = os.path.abspath(path)
+        stack = [(name, f) for f in self.defined.get(name, ()) if is_within(f, path)]
+        seen = set(stack)
+        while stack:
+            test, file_name = stack.pop()
+            declaration = self.files[file_name]['tests'].get(test)
+            for dep in declaration['after'] if declaration else ():
+                if dep in self.files[file_name]['defined']:
+                    candidates = [file_name]
+                else:
+                    candidates = self.defined.get(dep, ())
+                    candidates = [f for f in candidates if is_within(f, path)] or candidates
+                for f in candidates:
+                    if (dep, f) not in seen:
+                        seen.add((dep, f))
+                        stack.append((dep, f))
+        return sorted(set(f for _, f in seen))
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class HookProfile(object):
+    """Call counts, total times and latency histograms of the plugin hooks
+
+    Bucket k of a histogram counts the calls that took less than 2**k
+    microseconds (and at least half that). Hooks can run in several threads
+    at once, so the hooks being timed are tracked per thread.
+    """
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.histograms = defaultdict(lambda: defaultdict(int))
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        """The hooks being timed in the current thread"""
+        if not hasattr(self.local, 'active'):
+            self.local.active = set()
+        return self.local.active
+
+    def record(self, name, elapsed):
+        with self.lock:
+            self.counts[name] += 1
+            self.totals[name] += elapsed
+            self.histograms[name][int(elapsed * 1e6).bit_length()] += 1
+
+    def merge(self, stats):
+        """Add the stats of another profile, like the one of a worker process"""
+        for name, hook in stats.items():
+            self.counts[name] += hook['count']
+            self.totals[name] += hook['total']
+            for bound, count in hook['histogram']:
+                self.histograms[name][bound.bit_length() - 1] += count
+
+    def stats(self):
+        """Dict from hook name to its count, total seconds and histogram
+
+        The histogram is a list of [bound, count] with the upper bound of each
+        non-empty bucket in microseconds.
+        """
+        return dict((name, {'count': self.counts[name],
+                            'total': self.totals[name],
+                            'histogram': [[2 ** k, c] for k, c in
+                                          sorted(self.histograms[name].items())]})
+                    for name in self.counts)
+
+    def save(self, profile_file):
+        with open(profile_file, 'w') as f:
+            json.dump({'hooks': self.stats()}, f, indent=1, sort_keys=True)
+
+
+# The HookProfile of the session, when it was enabled with --nosedep-profile
+hook_profile = None
+
+
+def profiled(name):
+    """Record the time of every call in hook_profile, if there is one
+
+    Recursive calls are part of the outermost call and not counted.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            profile = hook_profile
+            if profile is None or name in profile.active:
+                return func(*args, **kwargs)
+            profile.active.add(name)
+            start = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.record(name, clock() - start)
+                profile.active.discard(name)
+        return inner
+    return decorator
 
 
 class DepLoader(TestLoader):
-    """Loader that stores what was specified but still loads all tests"""
+    """Loader that stores what was specified but still loads all tests
+
+    With a dependency index only the files that the specified tests need
+    are loaded.
+    """
 
     # noinspection PyPep8Naming
-    def __init__(self, config=None, importer=None, workingDir=None, selector=None):
+    def __init__(self, config=None, importer=None, workingDir=None, selector=None, index=None):
         super(DepLoader, self).__init__(config, importer, workingDir, selector)
         self.tests = []
+        self.index = index
 
+    @profiled('DepLoader.loadTestsFromName')
     def loadTestsFromName(self, name, module=None, discovered=False):
         """Need to load all tests since we might have dependencies"""
+        targets = self.targets(name)
+        if len(targets) == 1:
+            return super(DepLoader, self).loadTestsFromName(targets[0], module, discovered)
+        return self.suiteClass([super(DepLoader, self).loadTestsFromName(t, module, discovered)
+                                for t in targets])
+
+    @profiled('DepLoader.loadTestsFromNames')
+    def loadTestsFromNames(self, names, module=None):
+        """Load each file or directory only once
+
+        When many tests of the same file are named the file would otherwise
+        be loaded once per name.
+        """
+        plugin_suite = None
+        plugin_result = self.config.plugins.loadTestsFromNames(names, module)
+        if plugin_result:
+            plugin_suite, names = plugin_result
+        targets, seen = [], set()
+        for name in names:
+            for target in self.targets(name):
+                path = os.path.normpath(os.path.join(self.workingDir, target))
+                key = path if os.path.exists(path) else target
+                if key not in seen:
+                    seen.add(key)
+                    targets.append(target)
+        suites = [super(DepLoader, self).loadTestsFromName(t, module) for t in targets]
+        if plugin_suite:
+            suites.insert(0, self.suiteClass(plugin_suite))
+        return self.suiteClass(suites)
+
+    def targets(self, name):
+        """Store the test specified by name and return what to load for it"""
         if name == '.':
             # FIXME: This is current workaround that should be handled better
             #        The problem is that the tests in tests.py that do not set
@@ -171,8 +1274,8 @@ class DepLoader(TestLoader):
             #        Use of '.' here cause calls with the absolute path
             #        which on windows contain : and linux not causing us
             #        to handle this case differently.
-            #        For now return an empty suite until we can handle this better.
-            return self.suiteClass([])
+            #        For now load nothing until we can handle this better.
+            return []
 
         # Would have been nice to use nose.util.split_test_name(name) here
         # but for some reason it cause an recursive loop of test loading
@@ -180,15 +1283,326 @@ class DepLoader(TestLoader):
         parts = name.split(':' if ':' in name else '.') if not name.endswith('.py') else [name]
 
         if len(parts) == 2 and parts[1]:
-            if not has_class(parts[0], parts[1]):
-                self.tests.append(parts[-1].split('.')[-1])
-        return super(DepLoader, self).loadTestsFromName(parts[0], module, discovered)
+            if not has_class(parts[0], parts[1], self.importer):
+                test = parts[-1].split('.')[-1]
+                self.tests.append(test)
+                if self.index is not None:
+                    files = self.index.closure_files(test, os.path.join(self.workingDir, parts[0]))
+                    if files:
+                        return files
+        return [parts[0]]
+
+
+class Outcomes(JsonStore):
+    """Persistent outcomes of the last run, used by --nosedep-failed
+
+    Stores the status of every test that ran, and which of the skipped tests
+    were skipped because of a dependency. `rerun` are the tests that did not
+    pass for a reason other than a plain skip.
+    """
+    fields = ('statuses', 'dependency_skipped')
+
+    def __init__(self, results_file):
+        super(Outcomes, self).__init__(results_file)
+        data = self.load()
+        self.statuses = data.get('statuses', {})
+        self.dependency_skipped = data.get('dependency_skipped', [])
+
+    @property
+    def rerun(self):
+        failed = set(n for n, s in self.statuses.items() if s in (FAILED, ERRORED))
+        return sorted(failed.union(self.dependency_skipped))
+
+    @staticmethod
+    def is_dependency_skip(reason):
+        return str(reason).startswith("Required test '")
+
+    def update(self, statuses, result):
+        """Replace the stored outcomes with the ones of this run
+
+        The result lists are used as well, since with the multiprocess plugin
+        the outcomes of the tests are only known to the result object.
+        """
+        self.statuses = dict(statuses)
+        for status, entries in ((FAILED, result.failures), (ERRORED, result.errors)):
+            for test, _ in entries:
+                # A suite in this list failed in its fixtures
+                for name in unit_names(test) if isinstance(test, unittest.TestSuite) else \
+                        [NoseDep.test_name(test)]:
+                    self.statuses[name] = status
+        self.dependency_skipped = []
+        skipped = getattr(result, 'skipped', [])
+        error_classes = getattr(result, 'errorClasses', {})
+        if SkipTest in error_classes:
+            # Where the Skip plugin and the multiprocess plugin store them
+            skipped = error_classes[SkipTest][0]
+        for test, reason in skipped:
+            name = NoseDep.test_name(test)
+            self.statuses.setdefault(name, SKIPPED)
+            if self.is_dependency_skip(reason):
+                self.dependency_skipped.append(name)
+
+    def save(self):
+        self.dump(statuses=self.statuses, dependency_skipped=sorted(self.dependency_skipped))
+
+
+def source_hash(test):
+    """Hash of the source of the function or method of a test, None if unknown"""
+    case = getattr(test, 'test', test)
+    if isinstance(case, FunctionTestCase):
+        func = case.test
+    elif isinstance(case, MethodTestCase):
+        func = case.method
+    else:
+        func = getattr(case, getattr(case, '_testMethodName', ''), None)
+    func = getattr(func, '__func__', func)
+    while hasattr(func, '__wrapped__'):
+        func = func.__wrapped__
+    try:
+        source = inspect.getsource(func)
+    except (TypeError, IOError, OSError):
+        return None
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.sha1(source).hexdigest()
+
+
+class ResultCache(JsonStore):
+    """Outcomes of earlier runs keyed by the source of the tests
+
+    The key of a test is a hash of its own source and the sources of all
+    tests it transitively depends on with 'after', so changing any of them
+    invalidates the entry.
+    """
+    fields = ('tests',)
+
+    def __init__(self, cache_file):
+        super(ResultCache, self).__init__(cache_file)
+        self.tests = self.load().get('tests', {})
+        self.sources = {}
+
+    def collect(self, suite):
+        """Hash the sources of all tests in a suite"""
+        for test in suite:
+            if isinstance(test, unittest.TestSuite):
+                self.collect(test)
+            elif isinstance(test, Test):
+                digest = source_hash(test)
+                if digest is not None:
+                    self.sources[NoseDep.test_name(test)] = digest
+
+    def key(self, name):
+        closure = hard_closure([name])
+        if not all(n in self.sources for n in closure):
+            return None
+        joined = '\n'.join('{} {}'.format(n, self.sources[n]) for n in sorted(closure))
+        return hashlib.sha1(joined.encode('utf-8')).hexdigest()
+
+    def hit(self, name):
+        """True if the test passed before and neither it nor its dependencies changed"""
+        entry = self.tests.get(name)
+        return entry is not None and entry['status'] == PASSED and entry['key'] == self.key(name)
+
+    def update(self, statuses):
+        for name, status in statuses.items():
+            key = self.key(name)
+            if key is not None:
+                self.tests[name] = {'key': key, 'status': status}
+
+    def save(self):
+        self.dump(tests=self.tests)
+
+
+class DurationHistory(JsonStore):
+    """How long each test took the last time it ran
+
+    Read once when a session begins and written once when it ends.
+    """
+    fields = ('durations',)
+
+    def __init__(self, durations_file):
+        super(DurationHistory, self).__init__(durations_file)
+        self.durations = self.load().get('durations', {})
+
+    def save(self):
+        self.dump(durations=self.durations)
+
+
+class Journal(object):
+    """Append only log of test outcomes, used by --nosedep-resume
+
+    Every outcome is written as a line with the status and the test name and
+    flushed right away, so it survives the process being killed. To also
+    survive the machine going down the file is synced, but at most every
+    `sync_interval` seconds or `sync_every` entries since syncing is slow.
+    """
+    sync_interval = 1.0
+    sync_every = 100
+
+    def __init__(self, journal_file, truncate=True):
+        if not truncate and os.path.isfile(journal_file):
+            # Drop the incomplete last line of a run that died while writing it
+            with open(journal_file, 'rb+') as f:
+                data = f.read()
+                f.truncate(data.rfind(b'\n') + 1)
+        self.file = open(journal_file, 'w' if truncate else 'a')
+        self.pending = 0
+        self.synced = time.time()
+
+    @staticmethod
+    def read(journal_file):
+        """The (name, status) entries of a journal, in the order they were written"""
+        if not os.path.isfile(journal_file):
+            return []
+        entries = []
+        with open(journal_file) as f:
+            for line in f:
+                # The last line is incomplete if the run died while writing it
+                if not line.endswith('\n'):
+                    break
+                status, _, name = line.rstrip('\n').partition(' ')
+                if status in status_rank and name:
+                    entries.append((name, status))
+        return entries
+
+    def write(self, name, status):
+        self.file.write('{} {}\n'.format(status, name))
+        self.file.flush()
+        self.pending += 1
+        if self.pending >= self.sync_every or time.time() - self.synced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.pending = 0
+        self.synced = time.time()
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+def file_digest(file_name):
+    with open(file_name, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class PlanFile(JsonStore):
+    """A resolved plan stored by --nosedep-plan-out for --nosedep-plan-in
+
+    Holds the settings it was made with, the global order, the selected
+    tests and the shard, together with the modification time, size and
+    hash of the files it was derived from. A file is only hashed when its
+    time or size differs, as it does in a fresh checkout of the same tree.
+    """
+    fields = ('settings', 'files', 'order', 'selected', 'shard')
+    separators = (',', ':')
+
+    def __init__(self, plan_file):
+        super(PlanFile, self).__init__(plan_file)
+        self.data = self.load()
+
+    def valid(self, settings, files):
+        """True if the plan was made with settings from the same files"""
+        if not self.data or self.data['settings'] != settings:
+            return False
+        recorded = self.data['files']
+        if set(recorded) != set(files):
+            return False
+        for file_name, (mtime, size, digest) in recorded.items():
+            try:
+                stat = os.stat(file_name)
+                if stat.st_mtime == mtime and stat.st_size == size:
+                    continue
+                if stat.st_size != size or file_digest(file_name) != digest:
+                    return False
+            except (IOError, OSError):
+                return False
+        return True
+
+    def save(self, settings, files, order, selected, shard):
+        stamps = {}
+        for file_name in files:
+            stat = os.stat(file_name)
+            stamps[file_name] = [stat.st_mtime, stat.st_size, file_digest(file_name)]
+        self.data = self.dump(settings=settings, files=stamps, order=order,
+                              selected=selected, shard=shard)
+
+
+class Plan(object):
+    """The global test order derived from the dependency registry
+
+    `order` is the result of NoseDep.calculate_dependencies and `position`
+    maps each test in it to its index so that membership and position
+    lookups do not have to scan the list.
+    """
+
+    def __init__(self, order):
+        self.order = order
+        self.position = dict((t, i) for i, t in enumerate(order))
+
+    def __contains__(self, test):
+        return test in self.position
+
+
+# Ordering modes, see NoseDep.calculate_dependencies
+LEVELS = 'levels'
+HEAP = 'heap'
+DURATION = 'duration'
+orderings = (LEVELS, HEAP, DURATION)
+
+_plans = {}
+
+
+def invalidate_plan():
+    """Drop the cached plans
+
+    Called by the `dependencies`, `soft_dependencies` and `priorities` views
+    whenever an edge or priority changes.
+    """
+    _plans.clear()
+    _closures.clear()
+
+
+def get_plan(ordering=LEVELS, durations=None):
+    """Return the cached plan, computing it if the registry changed
+
+    The DURATION ordering also depends on the durations, which are read once
+    per session. Whoever reads them has to invalidate the plan.
+    """
+    if ordering not in _plans:
+        _plans[ordering] = Plan(NoseDep.calculate_dependencies(ordering, durations))
+    return _plans[ordering]
+
+
+_closures = {}
+
+
+def hard_closure(tests):
+    """The tests and everything they transitively depend on with 'after'
+
+    Walks the graph iteratively with one visited set shared by all the
+    tests, so each test and edge is visited once however many prerequisites
+    the tests share. The result is cached per set of tests until the
+    registry changes.
+    """
+    key = frozenset(tests)
+    if key not in _closures:
+        closure, stack = set(key), list(key)
+        while stack:
+            for dep in dependencies.get(stack.pop(), ()):
+                if dep not in closure:
+                    closure.add(dep)
+                    stack.append(dep)
+        _closures[key] = frozenset(closure)
+    return _closures[key]
 
 
 def merge_dicts(d1, d2):
     d3 = defaultdict(set)
     for k, v in chain(iter(d1.items()), iter(d2.items())):
-        d3[k] |= v
+        d3[k].update(v)
     return d3
 
 
@@ -202,6 +1616,230 @@ def lo_prio(x):
     return priorities[x] <= default_priority
 
 
+def split_units(tests):
+    """Break suites without fixtures up into the tests they contain
+
+    A suite with fixtures has to run as a whole in a single process,
+    anything else can be scheduled test by test.
+    """
+    for test in tests:
+        if isinstance(test, ContextSuite) and not test.hasFixtures():
+            for t in split_units(test):
+                yield t
+        else:
+            yield test
+
+
+def unit_names(unit):
+    """Names of the tests in a unit as used in the dependency registry"""
+    if isinstance(unit, LazySuite) and unit.test_generator is not None:
+        # Generated lazily, iterating it here would consume the tests
+        return []
+    if isinstance(unit, unittest.TestSuite):
+        return [n for t in unit for n in unit_names(t)]
+    return [NoseDep.test_name(unit)]
+
+
+def unit_graph(names):
+    """Dependency graph between units
+
+    :param names: The test names of each unit, as returned by unit_names.
+    :return: Dict from unit index to the indexes of the units it depends on.
+    """
+    owner = {}
+    for i, unit in enumerate(names):
+        for n in unit:
+            owner[n] = i
+    graph = {}
+    for i, unit in enumerate(names):
+        deps = (chain(dependencies.get(n, ()), soft_dependencies.get(n, ())) for n in unit)
+        graph[i] = set(owner[d] for d in chain.from_iterable(deps) if d in owner) - {i}
+    return graph
+
+
+class UnitScheduler(object):
+    """Release units as soon as the units they depend on are done
+
+    The counterpart of HeapScheduler for a graph returned by unit_graph. Of
+    the units that are ready the one that comes first in the plan is next.
+    """
+
+    def __init__(self, graph):
+        self.waiting = dict((i, len(deps)) for i, deps in graph.items())
+        self.dependents = defaultdict(list)
+        for i, deps in graph.items():
+            for d in deps:
+                self.dependents[d].append(i)
+        self.heap = sorted(i for i, n in self.waiting.items() if not n)
+
+    def pop(self):
+        """Take the next unit that is ready, None if there is none"""
+        return heapq.heappop(self.heap) if self.heap else None
+
+    def push(self, index):
+        """Give back a unit taken with pop that can not start yet"""
+        heapq.heappush(self.heap, index)
+
+    def done(self, index):
+        """Mark a unit taken with pop as done, releasing its dependents"""
+        for i in self.dependents[index]:
+            self.waiting[i] -= 1
+            if not self.waiting[i]:
+                heapq.heappush(self.heap, i)
+
+    def never_ready(self):
+        """Units that are never released as they are in a cycle between suites"""
+        return sorted(i for i, n in self.waiting.items() if n)
+
+
+def connected_components(graph):
+    """Split a unit graph into groups of units connected by dependencies
+
+    The groups are returned in the order of their first unit.
+    """
+    neighbours = defaultdict(set)
+    for unit, deps in graph.items():
+        for dep in deps:
+            neighbours[unit].add(dep)
+            neighbours[dep].add(unit)
+    seen = set()
+    components = []
+    for unit in sorted(graph):
+        if unit in seen:
+            continue
+        seen.add(unit)
+        component, stack = [], [unit]
+        while stack:
+            current = stack.pop()
+            component.append(current)
+            for n in neighbours[current] - seen:
+                seen.add(n)
+                stack.append(n)
+        components.append(sorted(component))
+    return components
+
+
+def partition(names, shards, durations=None):
+    """Split tests into shards that each hold the 'after' closure of their tests
+
+    Every test that no other test depends on forms an item together with its
+    closure. The items are placed largest first, each in the shard where it
+    adds the least, so prerequisites shared by several items tend to end up
+    in one shard but are copied to other shards when that balances better.
+    Tests weigh their recorded duration, or the average one if unknown, and
+    all weigh the same without durations. Only the names and durations are
+    used, so nodes that pass the same durations compute the same shards.
+
+    :return: The set of test names and the total weight of each shard.
+    """
+    names = set(names)
+    durations = dict((n, d) for n, d in (durations or {}).items() if n in names)
+    default = sum(durations.values()) / len(durations) if durations else 1.0
+
+    def weight(tests):
+        return sum(durations.get(n, default) for n in tests)
+
+    closures = dict((n, hard_closure([n]) & names) for n in names)
+    prerequisites = set(d for n in names for d in closures[n] if d != n)
+    items = sorted(((weight(closures[n]), n) for n in names if n not in prerequisites),
+                   key=lambda item: (-item[0], item[1]))
+    tests = [set() for _ in range(shards)]
+    loads = [0.0] * shards
+    for _, name in items:
+        added = [weight(closures[name] - tests[k]) for k in range(shards)]
+        best = min(range(shards), key=lambda k: (loads[k] + added[k], k))
+        tests[best] |= closures[name]
+        loads[best] += added[best]
+    return tests, loads
+
+
+def select_tests(suite, names):
+    """Drop the tests not in names from a prepared suite, True if any remain"""
+    if isinstance(suite, unittest.TestSuite):
+        suite._tests = [t for t in suite if select_tests(t, names)]
+        return bool(suite._precache)
+    return NoseDep.test_name(suite) in names
+
+
+def module_file(module):
+    file_name = getattr(module, '__file__', None)
+    if file_name and file_name.endswith(('.pyc', '.pyo')):
+        file_name = file_name[:-1]
+    return file_name and os.path.abspath(file_name)
+
+
+def suite_files(suite):
+    """Source files of the modules that the tests of a suite were loaded from"""
+    files, stack = set(), [suite]
+    while stack:
+        s = stack.pop()
+        context = getattr(s, 'context', None)
+        if inspect.isclass(context):
+            files.add(module_file(sys.modules.get(context.__module__)))
+            continue
+        if inspect.ismodule(context):
+            files.add(module_file(context))
+        if not isinstance(s, LazySuite) or s.test_generator is None:
+            stack.extend(t for t in s if isinstance(t, unittest.TestSuite))
+    files.discard(None)
+    return sorted(files)
+
+
+class RecordedTest(object):
+    """Stand-in for a test that ran in a worker process
+
+    Tests can not be sent between processes, so the outcome is replayed
+    against this object instead. It describes itself the same way the
+    original test did.
+    """
+    failureException = AssertionError
+
+    def __init__(self, test):
+        self.name = str(test)
+        self.test_id = test.id()
+        self.description = test.shortDescription()
+
+    def __str__(self):
+        return self.name
+
+    def id(self):
+        return self.test_id
+
+    def shortDescription(self):
+        return self.description
+
+
+class NamedTest(RecordedTest):
+    """Stand-in for a test only known by name, like one restored from the journal"""
+
+    def __init__(self, name):
+        self.name = self.test_id = name
+        self.description = None
+
+
+# Module part of the address of a DependencyGroup. Not a valid module name
+# so it can not collide with the address of a real test.
+group_prefix = 'nosedep-group'
+
+
+class DependencyGroup(LazySuite):
+    """Units connected by dependencies, for nose's multiprocess plugin
+
+    The multiprocess plugin sends each test or suite to a worker by address
+    and the worker loads it again. A group can not be split by the plugin and
+    has an address that NoseDep.loadTestsFromName resolves in the worker,
+    so that a whole dependency chain runs in order in a single worker.
+    """
+    can_split = False
+
+    def __init__(self, index, units):
+        super(DependencyGroup, self).__init__(units)
+        self.index = index
+
+    def address(self):
+        return None, group_prefix, str(self.index)
+
+
 class NoseDep(Plugin):
     """Allow specifying test dependencies with the depends decorator."""
     name = "nosedep"
@@ -211,60 +1849,357 @@ class NoseDep(Plugin):
         super(NoseDep, self).__init__()
         self.loader = None
         self.ok_results = set()
+        self.statuses = {}
         self.results = None
         self.disable = False
+        self.workers = 0
+        self.fork = 0
+        self.threads = 0
+        # Held while the outcomes are updated, tests can run in threads
+        self.lock = threading.RLock()
+        self.local = threading.local()
+        self.async_limit = 0
+        self.resource_limits = {}
+        self.resource_waits = {}
+        self.multiprocess = False
+        self.groups = {}
+        self.index_file = None
+        self.ordering = LEVELS
+        self.failed = False
+        self.rerun = []
+        self.rerun_missing = []
+        self.results_file = None
+        self.worker = False
+        self.cache_file = None
+        self.cache_force = False
+        self.cache = None
+        self.cached = set()
+        self.journal_file = None
+        self.journal = None
+        self.resume = False
+        self.finished = set()
+        self.resumed_failures = []
+        self.durations_file = None
+        self.durations = {}
+        self.shard_durations = False
+        self.started = {}
+        self.timings = {}
+        self.shard = None
+        self.shard_tests = None
+        self.shard_loads = None
+        self.plan_out = None
+        self.plan_in = None
+        self.plan_loaded = False
+        self.selected = None
+        self.preview = False
+        self.preview_lines = []
+        self.profile_file = None
+        self.profile = None
 
     def options(self, parser, env):
         super(NoseDep, self).options(parser, env)
+        parser.add_option('--nosedep-workers', action='store', metavar='N',
+                          default=env.get('NOSE_NOSEDEP_WORKERS', 0),
+                          dest='nosedep_workers',
+                          help='Run independent tests and dependency chains in N '
+                               'worker processes. [NOSE_NOSEDEP_WORKERS]')
+        parser.add_option('--nosedep-fork', action='store', metavar='N',
+                          default=env.get('NOSE_NOSEDEP_FORK', 0),
+                          dest='nosedep_fork',
+                          help='Run the tests in this process, but when a test passes that '
+                               'several independent chains of tests depend on, fork up to N '
+                               'processes that run these chains and share what the test '
+                               'built. [NOSE_NOSEDEP_FORK]')
+        parser.add_option('--nosedep-threads', action='store', metavar='N',
+                          default=env.get('NOSE_NOSEDEP_THREADS', 0),
+                          dest='nosedep_threads',
+                          help='Run each test in one of N threads as soon as the tests it '
+                               'depends on are done. Tests of a class with fixtures run in '
+                               'the same thread. [NOSE_NOSEDEP_THREADS]')
+        parser.add_option('--nosedep-async', action='store', metavar='N',
+                          default=env.get('NOSE_NOSEDEP_ASYNC', 0),
+                          dest='nosedep_async',
+                          help='Run the tests of coroutine functions that are ready '
+                               'concurrently on one event loop, up to N at a time. '
+                               '[NOSE_NOSEDEP_ASYNC]')
+        parser.add_option('--nosedep-resources', action='store', metavar='NAME:AMOUNT,...',
+                          default=env.get('NOSE_NOSEDEP_RESOURCES'),
+                          dest='nosedep_resources',
+                          help='How much there is of the resources that tests declare with '
+                               'depends(resources=...), like db:2,mem:16G. By default a '
+                               'resource is used by one test at a time. '
+                               '[NOSE_NOSEDEP_RESOURCES]')
+        parser.add_option('--nosedep-index', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_INDEX'),
+                          dest='nosedep_index',
+                          help='Keep an index of the test dependencies in FILE so that '
+                               'running specific tests only loads the files they '
+                               'need. [NOSE_NOSEDEP_INDEX]')
+        parser.add_option('--nosedep-order', action='store', type='choice',
+                          choices=orderings,
+                          default=env.get('NOSE_NOSEDEP_ORDER', LEVELS),
+                          dest='nosedep_order',
+                          help="How tests in dependency chains are ordered: 'levels' runs "
+                               "them level by level, 'heap' runs each test as soon as "
+                               "its dependencies are done, 'duration' runs each level "
+                               "longest chain first using the recorded durations. "
+                               "Default: %default. [NOSE_NOSEDEP_ORDER]")
+        parser.add_option('--nosedep-failed', action='store_true',
+                          default=env.get('NOSE_NOSEDEP_FAILED', False),
+                          dest='nosedep_failed',
+                          help='Run only the tests that failed, errored or were skipped '
+                               'because of a dependency in the last run, together with '
+                               'the tests they depend on. Runs everything if there were '
+                               'none. [NOSE_NOSEDEP_FAILED]')
+        parser.add_option('--nosedep-results', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_RESULTS', '.nosedep-results'),
+                          dest='nosedep_results',
+                          help='Where --nosedep-failed keeps the outcomes of the last '
+                               'run. Default: %default [NOSE_NOSEDEP_RESULTS]')
+        parser.add_option('--nosedep-cache', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_CACHE'),
+                          dest='nosedep_cache',
+                          help='Cache test outcomes in FILE. When specific tests are run '
+                               'the tests they depend on are not run again if they passed '
+                               'before and neither they nor their dependencies changed. '
+                               '[NOSE_NOSEDEP_CACHE]')
+        parser.add_option('--nosedep-cache-force', action='store_true',
+                          default=env.get('NOSE_NOSEDEP_CACHE_FORCE', False),
+                          dest='nosedep_cache_force',
+                          help='Run the dependencies even if they are cached, and '
+                               'update the cache. [NOSE_NOSEDEP_CACHE_FORCE]')
+        parser.add_option('--nosedep-durations', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_DURATIONS'),
+                          dest='nosedep_durations',
+                          help='Record how long each test takes in FILE. Defaults to '
+                               '.nosedep-durations with --nosedep-order=duration. '
+                               'Shards are only balanced with the durations when FILE '
+                               'is given. [NOSE_NOSEDEP_DURATIONS]')
+        parser.add_option('--nosedep-shard', action='store', metavar='K/N',
+                          default=env.get('NOSE_NOSEDEP_SHARD'),
+                          dest='nosedep_shard',
+                          help='Split the tests into N shards and only run shard K (1 to N). '
+                               'A shard holds all tests that its tests depend on, and the '
+                               'shards are balanced by the number of tests, or with the '
+                               'durations in --nosedep-durations, which must then be the '
+                               'same file on every node. [NOSE_NOSEDEP_SHARD]')
+        parser.add_option('--nosedep-journal', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_JOURNAL'),
+                          dest='nosedep_journal',
+                          help='Log the outcome of each test to FILE as soon as it is '
+                               'known. [NOSE_NOSEDEP_JOURNAL]')
+        parser.add_option('--nosedep-resume', action='store_true',
+                          default=env.get('NOSE_NOSEDEP_RESUME', False),
+                          dest='nosedep_resume',
+                          help='Continue the run logged with --nosedep-journal, only '
+                               'running the tests that have no outcome in it yet. '
+                               '[NOSE_NOSEDEP_RESUME]')
+        parser.add_option('--nosedep-plan-out', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_PLAN_OUT'),
+                          dest='nosedep_plan_out',
+                          help='Store the resolved test order, selection and shard in '
+                               'FILE. [NOSE_NOSEDEP_PLAN_OUT]')
+        parser.add_option('--nosedep-plan-in', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_PLAN_IN'),
+                          dest='nosedep_plan_in',
+                          help='Use the plan stored with --nosedep-plan-out in FILE instead '
+                               'of computing it, unless the test files or the options it '
+                               'depends on changed. [NOSE_NOSEDEP_PLAN_IN]')
+        parser.add_option('--nosedep-preview', action='store_true',
+                          default=env.get('NOSE_NOSEDEP_PREVIEW', False),
+                          dest='nosedep_preview',
+                          help='Do not run the tests but list them in the order they would '
+                               'run, with their dependency level, priority and why they are '
+                               'included. [NOSE_NOSEDEP_PREVIEW]')
+        parser.add_option('--nosedep-profile', action='store', metavar='FILE',
+                          default=env.get('NOSE_NOSEDEP_PROFILE'),
+                          dest='nosedep_profile',
+                          help='Time the hooks of the plugin and write their call counts, '
+                               'total times and latency histograms to FILE as JSON. '
+                               '[NOSE_NOSEDEP_PROFILE]')
 
     def configure(self, options, conf):
-        self.disable = getattr(conf.parser.values, 'collect_only', False)
+        self.preview = bool(getattr(options, 'nosedep_preview', False))
+        self.disable = getattr(conf.parser.values, 'collect_only', False) and not self.preview
+        self.preview_lines = []
+        self.workers = int(getattr(options, 'nosedep_workers', 0) or 0)
+        self.fork = int(getattr(options, 'nosedep_fork', 0) or 0)
+        self.threads = int(getattr(options, 'nosedep_threads', 0) or 0)
+        self.async_limit = int(getattr(options, 'nosedep_async', 0) or 0)
+        if self.async_limit and asyncio is None:
+            raise ValueError("--nosedep-async needs asyncio, which requires Python 3")
+        runners = [option for option, count in (('--nosedep-workers', self.workers),
+                                                ('--nosedep-fork', self.fork),
+                                                ('--nosedep-threads', self.threads)) if count > 1]
+        if self.async_limit and runners:
+            raise ValueError("--nosedep-async can not be combined with {}".format(runners[0]))
+        limits = getattr(options, 'nosedep_resources', None)
+        self.resource_limits = parse_resources(limits.split(',')) if limits else {}
+        self.resource_waits = {}
+        # The multiprocess plugin copies the options to its workers
+        # which is how the workers learn about the dependency groups
+        self.multiprocess = (int(getattr(options, 'multiprocess_workers', 0) or 0) > 0 and
+                             not getattr(conf, 'worker', False))
+        self.groups = getattr(options, 'nosedep_groups', None) or {}
+        self.index_file = getattr(options, 'nosedep_index', None)
+        self.ordering = getattr(options, 'nosedep_order', None) or LEVELS
+        self.failed = bool(getattr(options, 'nosedep_failed', False))
+        self.rerun = []
+        self.rerun_missing = []
+        self.results_file = getattr(options, 'nosedep_results', None) or '.nosedep-results'
+        self.worker = getattr(conf, 'worker', False)
+        self.cache_file = getattr(options, 'nosedep_cache', None)
+        self.cache_force = bool(getattr(options, 'nosedep_cache_force', False))
+        self.journal_file = getattr(options, 'nosedep_journal', None)
+        self.resume = bool(getattr(options, 'nosedep_resume', False))
+        self.durations_file = getattr(options, 'nosedep_durations', None)
+        # Only a file given explicitly is assumed to be shared by all shards
+        self.shard_durations = bool(self.durations_file)
+        if not self.durations_file and self.ordering == DURATION:
+            self.durations_file = '.nosedep-durations'
+        shard = getattr(options, 'nosedep_shard', None)
+        self.shard = self.shard_loads = None
+        if shard:
+            m = re.match(r'^(\d+)/(\d+)$', shard)
+            if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+                raise ValueError("--nosedep-shard should be K/N with 1 <= K <= N, not '{}'"
+                                 .format(shard))
+            self.shard = int(m.group(1)), int(m.group(2))
+        self.shard_tests = getattr(options, 'nosedep_shard_tests', None)
+        self.plan_out = getattr(options, 'nosedep_plan_out', None)
+        self.plan_in = getattr(options, 'nosedep_plan_in', None)
+        self.plan_loaded = False
+        self.selected = None
+        self.profile_file = getattr(options, 'nosedep_profile', None)
         super(NoseDep, self).configure(options, conf)
+        global hook_profile
+        self.profile = HookProfile() if self.enabled and self.profile_file else None
+        hook_profile = self.profile
 
+    def begin(self):
+        if self.disable:
+            return
+        self.durations = {}
+        self.finished = set()
+        if self.durations_file:
+            self.durations = DurationHistory(self.durations_file).durations
+            invalidate_plan()
+        if not self.journal_file:
+            return
+        if self.resume:
+            restored = {}
+            for name, status in Journal.read(self.journal_file):
+                self.record_status(name, status)
+                self.finished.add(name)
+                if status_rank[status] > status_rank[restored.get(name, PASSED)]:
+                    restored[name] = status
+            self.resumed_failures = sorted((n, s) for n, s in restored.items()
+                                           if s in (FAILED, ERRORED))
+        # Multiprocess workers add to the journal of the main process
+        self.journal = Journal(self.journal_file, truncate=not (self.resume or self.worker))
+
+    @profiled('prepareTestLoader')
     def prepareTestLoader(self, loader):
         if self.disable:
             return None
-        self.loader = DepLoader(loader.config, loader.importer, loader.workingDir, loader.selector)
+        index = None
+        if self.index_file:
+            index = DependencyIndex(self.index_file).update(loader.workingDir,
+                                                            loader.config.testMatch)
+            index.save()
+        self.loader = DepLoader(loader.config, loader.importer, loader.workingDir, loader.selector,
+                                index)
+        if self.failed:
+            self.rerun = Outcomes(self.results_file).rerun
+            self.loader.tests.extend(self.rerun)
         return self.loader
 
     @staticmethod
-    def calculate_dependencies():
+    @profiled('calculate_dependencies')
+    def calculate_dependencies(ordering=LEVELS, durations=None):
         """Calculate test dependencies
         First do a topological sorting based on the dependencies.
         Then sort the different dependency groups based on priorities.
+
+        With the HEAP ordering there are no groups, each test is instead
+        placed as early as its priority and dependencies allow. With the
+        DURATION ordering tests with the same priority in a group are sorted
+        by their critical path, longest first.
         """
+        if ordering == HEAP:
+            return list(HeapScheduler(registry))
+        key = None
+        if ordering == DURATION:
+            paths = registry.critical_paths(durations or {})
+
+            def key(x):
+                return priorities[x], -paths[x], x
         order = []
-        for g in toposort(merge_dicts(dependencies, soft_dependencies)):
-            for t in sorted(g, key=lambda x: (priorities[x], x)):
-                order.append(t)
+        for g in registry.sorted_levels(key):
+            order.extend(g)
         return order
 
+    @profiled('orderTests')
     def orderTests(self, all_tests, test):
         """Determine test ordering based on the dependency graph"""
-        order = self.calculate_dependencies()
-        ordered_all_tests = sorted(list(all_tests.keys()), key=lambda x: (priorities[x], x))
+        plan = get_plan(self.ordering, self.durations)
+        ordered_all_tests = sorted(list(all_tests.keys()),
+                                   key=lambda x: self.sort_key(x, all_tests[x]))
         conds = [lambda t: True, lambda t: t in all_tests]
         if self.loader.tests:  # If specific tests were mentioned on the command line
-            def mark_deps(t):
-                if t in dependencies:
-                    for dep in dependencies[t]:
-                        setattr(all_tests[dep], 'nosedep_run', True)
-                        mark_deps(dep)
-
-            for t in self.loader.tests:
-                if t in all_tests:
+            # The tests may live in other suites while some of their
+            # dependencies are in this one
+            selected = self.selected
+            if selected is None:
+                selected = hard_closure(self.loader.tests)
+            if self.cache is not None and not self.cache_force:
+                selected = selected - self.cached_dependencies(all_tests, selected)
+            for t in all_tests:
+                if t in selected:
                     setattr(all_tests[t], 'nosedep_run', True)
-                    mark_deps(t)
 
             conds[0] = conds[1] = \
                 lambda t: t in all_tests and getattr(all_tests[t], 'nosedep_run', False)
 
-        no_deps = (t for t in ordered_all_tests if t not in order and conds[0](t))
-        deps = (t for t in order if conds[1](t))
+        no_deps = (t for t in ordered_all_tests
+                   if t not in plan and t not in self.finished and conds[0](t))
+        deps = sorted((t for t in all_tests
+                       if t in plan and t not in self.finished and conds[1](t)),
+                      key=plan.position.__getitem__)
         no_deps_l, no_deps_h = split_on_condition(no_deps, lo_prio)
         test._tests = (all_tests[t] for t in chain(no_deps_l, deps, no_deps_h))
         return test
 
+    def sort_key(self, name, test):
+        """Order of tests outside dependency chains
+
+        With the DURATION ordering the longest ones go first among the ones
+        with the same priority, a suite taking as long as all its tests.
+        """
+        if self.ordering == DURATION:
+            return priorities[name], -self.duration(name, test), name
+        return priorities[name], name
+
+    def duration(self, name, test=None):
+        if name in self.durations:
+            return self.durations[name]
+        if isinstance(test, unittest.TestSuite):
+            return sum(self.duration(n) for n in unit_names(test))
+        return 0.0
+
+    def cached_dependencies(self, all_tests, selected):
+        """Dependencies in all_tests that do not have to run since they are cached
+
+        They are recorded as passed, so that the tests depending on them run.
+        """
+        cached = set()
+        for t in all_tests:
+            if t in selected and t not in self.loader.tests and self.cache.hit(t):
+                cached.add(t)
+                self.cached.add(t)
+                self.record_status(t, PASSED)
+        return cached
+
     def prepare_suite(self, suite):
         """Prepare suite and determine test ordering"""
         all_tests = {}
@@ -278,6 +2213,7 @@ class NoseDep(Plugin):
 
         return self.orderTests(all_tests, suite)
 
+    @profiled('prepareTest')
     def prepareTest(self, test):
         """Prepare and determine test ordering"""
         if self.disable:
@@ -285,11 +2221,170 @@ class NoseDep(Plugin):
 
         all_tests = {}
 
+        if self.cache_file and not self.worker:
+            self.cache = ResultCache(self.cache_file)
+            self.cache.collect(test)
+        if self.plan_in and not self.worker:
+            self.load_plan(test)
+        if self.rerun and not self.worker:
+            collected = set(n for unit in test for n in unit_names(unit))
+            self.rerun_missing = [n for n in self.rerun if n not in collected]
         # When passing a directory to nose we have an extra
         # top level that we need to enter.
         all_tests = self.prepare_tests_on_levels(test, all_tests)
-        return self.orderTests(all_tests, test)
+        test = self.orderTests(all_tests, test)
+        if self.shard:
+            self.select_shard(test)
+        if self.plan_out and not self.worker:
+            self.save_plan(test)
+        if self.preview:
+            self.preview_plan(test)
+            test._tests = []
+            return test
+        # The runners import this module, so they are imported when needed
+        from nosedep_runners import AsyncRunner, FanoutRunner, ParallelRunner, ThreadRunner
+
+        if self.multiprocess:
+            test._tests = self.group_units(test)
+        elif self.workers > 1:
+            test._tests = [ParallelRunner(self, test, self.workers)]
+        elif self.fork > 1:
+            test._tests = [FanoutRunner(self, test, self.fork)]
+        elif self.threads > 1:
+            test._tests = [ThreadRunner(self, test, self.threads)]
+        elif self.async_limit > 0:
+            test._tests = [AsyncRunner(self, test, self.async_limit)]
+        elif isinstance(test, ContextSuite) and test.hasFixtures():
+            # The suite of a module given by name sets up the module fixtures
+            # before any of its units run
+            self.guard(test)
+        return test
 
+    def preview_plan(self, test):
+        """List the tests of a prepared suite in run order for --nosedep-preview"""
+        level = {}
+        for k, ids in enumerate(registry.levels()):
+            for i in ids:
+                level[registry.names[i]] = k
+        requested = set(self.loader.tests)
+        dependents = defaultdict(list)
+        if requested:
+            selected = self.selected if self.selected is not None else hard_closure(requested)
+            for name in sorted(selected):
+                for d in dependencies.get(name, ()):
+                    dependents[d].append(name)
+        lines, levels, stack = [], set(), [test]
+        while stack:
+            t = stack.pop()
+            if isinstance(t, unittest.TestSuite):
+                stack.extend(reversed(list(t)))
+                continue
+            name = self.test_name(t)
+            if not requested:
+                reason = 'collected'
+            elif name in requested:
+                reason = 'requested'
+            else:
+                reason = 'dependency of ' + ', '.join(dependents[name])
+            levels.add(level.get(name, 0))
+            lines.append('{}  level {}  priority {}  {}'.format(
+                t, level.get(name, 0), priorities[name], reason))
+        lines.append('nosedep preview: {} tests in {} levels'.format(len(lines), len(levels)))
+        self.preview_lines = lines
+
+    def plan_settings(self):
+        """The options that a stored plan has to be made with to be reused"""
+        return {'ordering': self.ordering, 'tests': sorted(self.loader.tests),
+                'shard': list(self.shard) if self.shard else None}
+
+    def plan_files(self, test):
+        """Files a stored plan depends on, relative so that any checkout can use it"""
+        files = suite_files(test)
+        if self.durations_file and os.path.isfile(self.durations_file):
+            files.append(self.durations_file)
+        return sorted(os.path.relpath(f) for f in files)
+
+    def load_plan(self, test):
+        """Take the order, selection and shard from --nosedep-plan-in if still valid
+
+        This only saves resolving the dependencies, the collected suites are
+        still ordered with the stored order afterwards.
+        """
+        plan_file = PlanFile(self.plan_in)
+        if not plan_file.valid(self.plan_settings(), self.plan_files(test)):
+            return
+        data = plan_file.data
+        _plans[self.ordering] = Plan(data['order'])
+        if data['selected'] is not None:
+            self.selected = frozenset(data['selected'])
+        if data['shard'] is not None:
+            self.shard_tests, self.shard_loads = set(data['shard'][0]), data['shard'][1]
+        self.plan_loaded = True
+
+    def save_plan(self, test):
+        selected = shard = None
+        if self.loader.tests:
+            selected = sorted(self.selected or hard_closure(self.loader.tests))
+        if self.shard_tests is not None:
+            shard = [sorted(self.shard_tests), self.shard_loads]
+        PlanFile(self.plan_out).save(self.plan_settings(), self.plan_files(test),
+                                     get_plan(self.ordering, self.durations).order,
+                                     selected, shard)
+
+    def select_shard(self, test):
+        """Keep only the tests of this node's shard
+
+        The multiprocess workers get the selected tests from the main process,
+        since each of them only sees a part of the tests. The durations are only
+        used when given with ``--nosedep-durations``, as the default file is
+        local to each node and the nodes would not agree on the split.
+        """
+        if self.shard_tests is None:
+            names = [n for unit in test for n in unit_names(unit)]
+            durations = self.durations if self.shard_durations else None
+            shards, self.shard_loads = partition(names, self.shard[1], durations)
+            self.shard_tests = shards[self.shard[0] - 1]
+        self.conf.options.nosedep_shard_tests = self.shard_tests
+        select_tests(test, self.shard_tests)
+
+    def group_units(self, tests):
+        """Group units connected by dependencies for the multiprocess plugin
+
+        Each group is stored in the options together with the addresses and
+        test names of its units, since that is what the workers get.
+        """
+        from nose.plugins.multiprocess import MultiProcessTestRunner
+
+        plan = get_plan(self.ordering, self.durations)
+        units = list(split_units(tests))
+        names = [unit_names(u) for u in units]
+        grouped = []
+        for component in connected_components(unit_graph(names)):
+            if len(component) == 1 and not any(n in plan or n in priorities
+                                               for n in names[component[0]]):
+                # Nothing to order, the multiprocess plugin may split it further
+                grouped.append(units[component[0]])
+                continue
+            group = DependencyGroup(len(self.groups), [units[i] for i in component])
+            addresses = [MultiProcessTestRunner.address(units[i]) for i in component]
+            group_names = [n for i in component for n in names[i]]
+            self.groups[MultiProcessTestRunner.address(group)] = (addresses, group_names)
+            grouped.append(group)
+        self.conf.options.nosedep_groups = self.groups
+        return grouped
+
+    @profiled('loadTestsFromName')
+    def loadTestsFromName(self, name, module=None, importPath=None):
+        """Load a dependency group in a multiprocess worker"""
+        if name not in self.groups:
+            return None
+        addresses, names = self.groups[name]
+        self.loader = DepLoader(self.conf)
+        suite = self.loader.loadTestsFromNames(addresses)
+        self.loader.tests = list(names)
+        return [self.prepareTest(suite)]
+
+    @profiled('prepare_tests_on_levels')
     def prepare_tests_on_levels(self, test, all_tests):
         """Find test level of ContextSuite object
 
@@ -310,6 +2405,8 @@ class NoseDep(Plugin):
                 if isinstance(test, ContextSuite):  # MethodTestCase
                     all_tests[test.context.__name__] = self.prepare_suite(test)
                     setattr(all_tests[test.context.__name__], 'nosedep_run', True)
+                    if test.hasFixtures():
+                        self.guard(test)
                 else:  # FunctionTestCase
                     all_tests[test.test.test.__name__] = test
                 break
@@ -318,41 +2415,108 @@ class NoseDep(Plugin):
                 reraise(test.test.exc_class, test.test.exc_val, test.test.tb)
         return all_tests
 
-    def dependency_failed(self, test):
-        """Returns an error string if any of the dependencies failed"""
-        for d in (self.test_name(i) for i in dependencies[test]):
-            if d in (self.test_name(str(t[0])) for t in self.results.failures):
-                return "Required test '{}' FAILED".format(d)
-            if d in (self.test_name(str(t[0])) for t in self.results.errors):
-                return "Required test '{}' ERRORED".format(d)
-            if d in (self.test_name(str(t[0])) for t in self.results.skipped):
-                return "Required test '{}' SKIPPED".format(d)
+    def dependency_failed(self, test, pending=None):
+        """Returns an error string if any of the dependencies failed
+
+        :param pending: Outcomes that are decided but not yet reported,
+                        these take precedence over the status index.
+        """
+        for d in (self.test_name(i) for i in dependencies.get(test, ())):
+            status = (pending or {}).get(d) or self.statuses.get(d)
+            if status in (FAILED, ERRORED, SKIPPED):
+                return "Required test '{}' {}".format(d, status)
         return None
 
     def dependency_ran(self, test):
         """Returns an error string if any of the dependencies did not run"""
-        for d in (self.test_name(i) for i in dependencies[test]):
+        for d in (self.test_name(i) for i in dependencies.get(test, ())):
             if d not in self.ok_results:
                 return "Required test '{}' did not run (does it exist?)".format(d)
         return None
 
+    @profiled('beforeTest')
     def beforeTest(self, test):
         """Skip or Error the test if the dependencies are not fulfilled"""
         tn = self.test_name(test)
-        res = self.dependency_failed(tn)
-        test.test._originalName = test.test._testMethodName
-        if res:
-            test.test.skipTestNoseDep = partial(test.test.skipTest, res)
-            test.test._testMethodName = 'skipTestNoseDep'
-            return
-        res = self.dependency_ran(tn)
-        if res:
-            def error_test():
-                raise Exception(res)
-            test.test.errTestNoseDep = error_test
-            test.test._testMethodName = 'errTestNoseDep'
+        with self.lock:
+            res = self.dependency_failed(tn)
+            test.test._originalName = test.test._testMethodName
+            if res:
+                test.test.skipTestNoseDep = partial(test.test.skipTest, res)
+                test.test._testMethodName = 'skipTestNoseDep'
+                return
+            res = self.dependency_ran(tn)
+            if res:
+                def error_test():
+                    raise Exception(res)
+                test.test.errTestNoseDep = error_test
+                test.test._testMethodName = 'errTestNoseDep'
+
+    def guard(self, suite):
+        """Skip a whole suite before its fixtures run if none of its tests can
+
+        beforeTest is only called after the class and module fixtures of a
+        test have been set up. When every test of a suite is going to be
+        skipped or errored anyway the fixtures are not run at all, and the
+        tests are reported directly with the same outcome and reason.
+        """
+        run = suite.run
+
+        def guarded_run(result):
+            outcomes = self.doomed(suite)
+            if outcomes is None:
+                return run(result)
+            self.report_doomed(outcomes, result)
+            return result
+        suite.run = guarded_run
+
+    def doomed(self, tests, pending=None):
+        """The (test, status, reason) of each test, None if any of them can run
+
+        A test depending on an earlier test of the same suite sees that test
+        as skipped or errored, as it would during a normal run. The suites in
+        a suite, like the classes of a module, are doomed when all their tests
+        are.
+        """
+        pending = {} if pending is None else pending
+        outcomes = []
+        for test in tests:
+            if isinstance(test, unittest.TestSuite):
+                inner = self.doomed(test, pending)
+                if inner is None:
+                    return None
+                outcomes.extend(inner)
+                continue
+            if not isinstance(test, Test):
+                return None
+            name = self.test_name(test)
+            reason = self.dependency_failed(name, pending)
+            status = SKIPPED
+            if not reason:
+                reason = self.dependency_ran(name)
+                status = ERRORED
+            if not reason:
+                return None
+            pending[name] = status
+            outcomes.append((test, status, reason))
+        return outcomes or None
+
+    def report_doomed(self, outcomes, result):
+        """Report the outcomes decided by doomed to the result and plugins
+
+        Goes through the result proxy of each test, like nose.case.Test.run.
+        """
+        for test, status, reason in outcomes:
+            proxy = test.resultProxy(result, test) if test.resultProxy else result
+            proxy.startTest(test)
+            if status == SKIPPED:
+                proxy.addSkip(test, reason)
+            else:
+                proxy.addError(test, (Exception, Exception(reason), None))
+            proxy.stopTest(test)
 
     # noinspection PyMethodMayBeStatic
+    @profiled('testName')
     def testName(self, test):
         """Implements the plugin interface
 
@@ -378,9 +2542,155 @@ class NoseDep(Plugin):
 
         return test_name.split('.')[-1]
 
+    def record_status(self, name, status):
+        """Store the outcome of a test in the status index"""
+        with self.lock:
+            current = self.statuses.get(name)
+            if current is None or status_rank[status] > status_rank[current]:
+                self.statuses[name] = status
+            if status == PASSED:
+                self.ok_results.add(name)
+            if self.journal is not None:
+                self.journal.write(name, status)
+
+    def is_error_class(self, exc_class):
+        """True if nose registered exc_class as a non standard error class
+
+        Such errors (like DEPRECATED) are stored separately by the result
+        object and are neither counted as errors nor as skips.
+        """
+        error_classes = getattr(self.results, 'errorClasses', {})
+        return any(issubclass(exc_class, cls) for cls in error_classes)
+
+    @profiled('addSuccess')
     def addSuccess(self, test):
         """The result object does not store successful results, so we have to do it"""
-        self.ok_results.add(self.test_name(test))
+        self.record_status(self.test_name(test), PASSED)
+
+    @profiled('addFailure')
+    def addFailure(self, test, err):
+        """Index failures so dependency_failed does not have to scan the result"""
+        self.record_status(self.test_name(test), FAILED)
+
+    @profiled('addError')
+    def addError(self, test, err):
+        """Index errors and skips
+
+        Nose reports skips to plugins through this hook as well, with
+        SkipTest as the exception class.
+        """
+        exc_class = err[0]
+        if inspect.isclass(exc_class) and issubclass(exc_class, SkipTest):
+            self.record_status(self.test_name(test), SKIPPED)
+        elif not (inspect.isclass(exc_class) and self.is_error_class(exc_class)):
+            self.record_status(self.test_name(test), ERRORED)
+
+    @profiled('startTest')
+    def startTest(self, test):
+        """Remember where the skips of the test will start in the result"""
+        self.local.skipped = len(getattr(self.results, 'skipped', None) or ())
+        if self.durations_file:
+            self.started[self.test_name(test)] = time.time()
+
+    @profiled('stopTest')
+    def stopTest(self, test):
+        """Index skips that never reached addError
+
+        When the Skip plugin is active it handles the SkipTest errors
+        before they are passed on to us, so we look at the entries added to
+        the skipped list of the result object since the test started. With
+        threads each test starts and stops in its own thread, and the others
+        may have added skips as well.
+        """
+        skipped = getattr(self.results, 'skipped', None)
+        start = getattr(self.local, 'skipped', 0)
+        if skipped and any(s[0] is test for s in skipped[start:]):
+            self.record_status(self.test_name(test), SKIPPED)
+        started = self.started.pop(self.test_name(test), None)
+        if started is not None:
+            self.timings[self.test_name(test)] = time.time() - started
+
+    def add_resumed_failures(self, result):
+        """Add the failures restored from the journal to the result
+
+        They happened before the run was interrupted, and the resumed run
+        must not pass without them. They are only added once.
+        """
+        for name, status in self.resumed_failures:
+            message = 'Test {} in the interrupted run'.format(status.lower())
+            if status == FAILED:
+                result.failures.append((NamedTest(name), message))
+            else:
+                result.errors.append((NamedTest(name), message))
+        self.resumed_failures = []
+
+    def add_missing_rerun(self, result):
+        """Fail a --nosedep-failed run that found none of the tests to run again
+
+        Otherwise it would pass without running anything, for instance when
+        the modules of the failed tests were not given this time.
+        """
+        if self.rerun_missing and len(self.rerun_missing) == len(self.rerun):
+            for name in self.rerun_missing:
+                result.errors.append((NamedTest(name), 'Test of the last run to run again '
+                                                       'was not collected'))
+        self.rerun_missing = []
+
+    def finalize(self, result):
+        """Store the outcomes for the next --nosedep-failed run and the cache"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.disable or self.worker:
+            return
+        self.add_resumed_failures(result)
+        self.add_missing_rerun(result)
+        if self.profile is not None:
+            self.profile.save(self.profile_file)
+        if self.failed:
+            outcomes = Outcomes(self.results_file)
+            outcomes.update(self.statuses, result)
+            outcomes.save()
+        if self.cache is not None:
+            self.cache.update(dict((n, s) for n, s in self.statuses.items()
+                                   if n not in self.cached))
+            self.cache.save()
+        if self.durations_file and self.timings:
+            history = DurationHistory(self.durations_file)
+            history.durations.update(self.timings)
+            history.save()
+
+    def report(self, stream):
+        for line in self.preview_lines:
+            stream.writeln(line)
+        for name, status in self.resumed_failures:
+            stream.writeln('nosedep resume: {} {} in the interrupted run'.format(name, status))
+        if self.rerun_missing:
+            stream.writeln('nosedep failed: {} of the last run not collected, so not run '
+                           'again'.format(', '.join(self.rerun_missing)))
+        if self.results is not None:
+            # The summary is printed after this, so it counts them as well
+            self.add_resumed_failures(self.results)
+            self.add_missing_rerun(self.results)
+        for name, (wait, needs) in sorted(self.resource_waits.items(),
+                                          key=lambda item: (-item[1][0], item[0])):
+            stream.writeln('nosedep resource wait: {} waited {:.2f}s for {}'.format(
+                name, wait, ', '.join(needs)))
+        if self.shard_loads is None:
+            return
+        loads = self.shard_loads
+        mean = sum(loads) / len(loads)
+        imbalance = max(loads) / mean - 1 if mean else 0
+        k, n = self.shard
+        if self.shard_durations and self.durations:
+            stream.writeln('nosedep shard {}/{}: {} tests, {:.1f}s '
+                           '(shards take {:.1f}s to {:.1f}s, '
+                           'imbalance {:.0%})'.format(k, n, len(self.shard_tests), loads[k - 1],
+                                                      min(loads), max(loads), imbalance))
+        else:
+            stream.writeln('nosedep shard {}/{}: {} tests (shards have {:.0f} to {:.0f} tests, '
+                           'imbalance {:.0%})'.format(k, n, len(self.shard_tests),
+                                                      min(loads), max(loads), imbalance))
 
     def prepareTestResult(self, result):
         """Store the result object so we can inspect it in beforeTest"""
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Warm test runs with the nosedep plugin
+
+A run of a few tests spends most of its time starting Python, importing nose
+and the test modules and planning the dependencies. The daemon does that once
+and keeps it in memory::
+
+    python -m nosedep_daemon serve &
+    python -m nosedep_daemon run -v --with-nosedep module.py:test_x
+    python -m nosedep_daemon stop
+
+It serves the directory it was started in. The arguments after ``run`` are the
+ones nosetests takes, and the output and exit code are the ones of nosetests.
+Modules whose files changed are loaded again before a run. When no daemon is
+running the tests run in the calling process instead.
+
+This module only imports the standard library, so that the client starts fast.
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+
+
+def connect(socket_file):
+    """A socket connected to the daemon on socket_file, None if none is running"""
+    if not hasattr(socket, 'AF_UNIX'):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_file)
+    except socket.error:
+        client.close()
+        return None
+    return client
+
+
+def request(client, message, stdout, stderr):
+    """Send a request to the daemon, write the output it sends back and return the exit code"""
+    try:
+        client.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        for line in client.makefile('rb'):
+            answer = json.loads(line.decode('utf-8'))
+            if 'exit' in answer:
+                return answer['exit']
+            if 'stdout' in answer:
+                stdout.write(answer['stdout'])
+            else:
+                stderr.write(answer['stderr'])
+    finally:
+        client.close()
+    stderr.write('nosedep daemon stopped during the run\n')
+    return 1
+
+
+def run_here(argv):
+    """Run nose in this process, as nosetests would"""
+    from nose.core import TestProgram
+    from nosedep import NoseDep
+    program = TestProgram(argv=['nosetests'] + argv, exit=False, addplugins=[NoseDep()])
+    return 0 if program.success else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m nosedep_daemon',
+        description='Keep the tests of the working directory loaded in a daemon so that '
+                    'test runs start without importing and planning everything again.')
+    parser.add_argument('--socket', default='.nosedep.sock',
+                        help='Unix socket of the daemon. Default: %(default)s')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='Serve runs until stopped')
+    commands.add_parser('run', help='Run nose with the arguments that follow in the daemon, '
+                                    'or in this process if no daemon is running')
+    commands.add_parser('stop', help='Stop the daemon')
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # Everything after run is for nose, argparse would take its options
+    nose_args = []
+    k = 0
+    while k < len(argv):
+        if argv[k] == '--socket':
+            k += 1
+        elif argv[k] == 'run':
+            argv, nose_args = argv[:k + 1], argv[k + 1:]
+        k += 1
+    args = parser.parse_args(argv)
+    if args.command == 'serve':
+        if not hasattr(socket, 'AF_UNIX'):
+            parser.error('the daemon needs Unix sockets')
+        from nosedep_server import Daemon
+        Daemon(args.socket, os.getcwd()).serve()
+        return 0
+    if args.command not in ('run', 'stop'):
+        parser.error('a command is required')
+    client = connect(args.socket)
+    if args.command == 'stop':
+        return 0 if client is None else request(client, {'stop': True}, sys.stdout, sys.stderr)
+    if client is None:
+        return run_here(nose_args)
+    env = dict((k, v) for k, v in os.environ.items() if k.startswith('NOSE_'))
+    return request(client, {'argv': nose_args, 'cwd': os.getcwd(), 'env': env},
+                   sys.stdout, sys.stderr)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
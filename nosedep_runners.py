@@ -0,0 +1,628 @@
+"""Runners that run the tests of a prepared suite concurrently
+
+NoseDep replaces the tests of the suite it prepared with one of these when
+``--nosedep-workers``, ``--nosedep-fork``, ``--nosedep-threads`` or
+``--nosedep-async`` is given. They all keep the order the dependencies
+require and report the outcomes through the plugin, so that dependents are
+still skipped when a test they depend on did not pass.
+"""
+import inspect
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+from collections import defaultdict
+from functools import wraps
+from itertools import chain
+
+from nose.case import FunctionTestCase
+from nose.plugins.skip import SkipTest
+from nose.proxy import ResultProxyFactory
+from nose.suite import LazySuite
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import nosedep
+from nosedep import (DURATION, PASSED, HookProfile, RecordedTest, UnitScheduler, asyncio,
+                     connected_components, dependencies, resource_needs, split_units,
+                     toposort_levels, unit_graph, unit_names)
+
+
+def fork_pool(processes):
+    """Return a pool of forked worker processes
+
+    Workers are forked so that they inherit the already loaded tests.
+    Returns None on platforms that can not fork.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    try:
+        context = multiprocessing.get_context('fork')
+    except AttributeError:
+        # Python 2 always forks
+        context = multiprocessing
+    return context.Pool(processes)
+
+
+class RemoteFailure(AssertionError):
+    """A failure in a worker process, the message is the original traceback"""
+
+
+class RemoteError(Exception):
+    """An error in a worker process, the message is the original traceback"""
+
+
+class RecordingResult(unittest.TestResult):
+    """Result that records all events so they can be replayed later"""
+
+    def __init__(self):
+        super(RecordingResult, self).__init__()
+        self.events = []
+        self.recorded = {}
+
+    def record(self, kind, test, detail=None):
+        key = id(test)
+        if key not in self.recorded:
+            self.recorded[key] = (test, RecordedTest(test))
+        self.events.append((kind, self.recorded[key][1], detail))
+
+    def startTest(self, test):
+        super(RecordingResult, self).startTest(test)
+        self.record('start', test)
+
+    def stopTest(self, test):
+        super(RecordingResult, self).stopTest(test)
+        self.record('stop', test)
+
+    def addSuccess(self, test):
+        super(RecordingResult, self).addSuccess(test)
+        self.record('success', test)
+
+    def addFailure(self, test, err):
+        super(RecordingResult, self).addFailure(test, err)
+        self.record('failure', test, self._exc_info_to_string(err, test))
+
+    def addError(self, test, err):
+        if inspect.isclass(err[0]) and issubclass(err[0], SkipTest):
+            self.addSkip(test, str(err[1]))
+            return
+        super(RecordingResult, self).addError(test, err)
+        self.record('error', test, self._exc_info_to_string(err, test))
+
+    def addSkip(self, test, reason):
+        super(RecordingResult, self).addSkip(test, reason)
+        self.record('skip', test, str(reason))
+
+    def addExpectedFailure(self, test, err):
+        super(RecordingResult, self).addExpectedFailure(test, err)
+        self.record('success', test)
+
+    def addUnexpectedSuccess(self, test):
+        super(RecordingResult, self).addUnexpectedSuccess(test)
+        self.record('failure', test, 'Unexpected success')
+
+
+class ResourcePool(object):
+    """Hands out resources to jobs running at the same time
+
+    The capacity of a resource that has none configured is the most that a
+    single job needs, so by default a resource is held by one job at a time.
+    A job needing more than the capacity runs when nobody else holds any.
+    """
+
+    def __init__(self, capacities, needs):
+        self.capacities = dict(capacities)
+        for need in needs:
+            for name, amount in need.items():
+                if name not in capacities:
+                    self.capacities[name] = max(self.capacities.get(name, 0), amount)
+        self.in_use = defaultdict(float)
+
+    def fits(self, need):
+        return all(not self.in_use[name] or
+                   self.in_use[name] + amount <= self.capacities[name]
+                   for name, amount in need.items())
+
+    def acquire(self, need):
+        for name, amount in need.items():
+            self.in_use[name] += amount
+
+    def release(self, need):
+        for name, amount in need.items():
+            self.in_use[name] -= amount
+
+
+# The runner of the current parallel run, inherited by forked workers
+_runner = None
+
+
+def _run_units(indexes, statuses):
+    """Entry point in the worker processes"""
+    return _runner.run_units(indexes, statuses)
+
+
+class ParallelRunner(LazySuite):
+    """Runs the units of a suite level by level in worker processes
+
+    The units are tests, or suites with fixtures. They are grouped in levels
+    with toposort_levels using the dependencies between the tests they contain,
+    and all units of a level run concurrently. Outcomes are replayed into
+    the result of the main process in plan order, which keeps the plugin's
+    status index up to date. Before a unit is sent to a worker it gets the
+    current status of the tests it depends on so that beforeTest can skip
+    or error it exactly as in a serial run.
+    """
+
+    def __init__(self, plugin, tests, processes):
+        self.plugin = plugin
+        self.processes = processes
+        self.units = list(split_units(tests))
+        self.names = [unit_names(u) for u in self.units]
+        self.levels = self.calculate_levels()
+        super(ParallelRunner, self).__init__(self.units)
+
+    def calculate_levels(self):
+        levels = [sorted(level) for level in toposort_levels(unit_graph(self.names))]
+        if self.plugin.ordering == DURATION:
+            # Longest first, so that the short ones fill up the workers at the end
+            for level in levels:
+                level.sort(key=lambda i: -sum(self.plugin.duration(n) for n in self.names[i]))
+        return levels
+
+    def snapshot(self, index):
+        """Status of the tests that the tests in a unit depend on"""
+        statuses = self.plugin.statuses
+        return dict((d, statuses[d])
+                    for n in self.names[index]
+                    for d in dependencies.get(n, ())
+                    if d in statuses)
+
+    def run(self, result):
+        global _runner
+        _runner = self
+        pool = fork_pool(self.processes)
+        if pool is None:
+            for unit in self.units:
+                if result.shouldStop:
+                    break
+                unit(result)
+            return
+        try:
+            for level in self.levels:
+                if result.shouldStop:
+                    break
+                self.run_jobs(pool, self.processes, [[i] for i in level], result)
+        finally:
+            pool.terminate()
+            pool.join()
+            _runner = None
+
+    def needs(self, job):
+        """What the units of a job hold, they run one after the other"""
+        need = {}
+        for n in chain.from_iterable(self.names[i] for i in job):
+            for name, amount in resource_needs.get(n, {}).items():
+                need[name] = max(need.get(name, 0), amount)
+        return need
+
+    def run_jobs(self, pool, slots, jobs, result, snapshot=True):
+        """Run lists of units in the pool, as many at a time as the resources allow
+
+        Jobs are started greedily in order, skipping the ones whose resources
+        are taken. The outcomes are replayed in the order of the jobs as soon
+        as all jobs before them are done. How long each job waited for its
+        resources is stored in the resource_waits of the plugin.
+        """
+        needs = [self.needs(job) for job in jobs]
+        resources = ResourcePool(self.plugin.resource_limits, needs)
+        waiting, running, outcomes, blocked = list(range(len(jobs))), {}, {}, {}
+        replayed = 0
+        while running or (waiting and not result.shouldStop):
+            now = time.time()
+            for k in list(waiting):
+                if len(running) >= slots or result.shouldStop:
+                    break
+                if not resources.fits(needs[k]):
+                    blocked.setdefault(k, now)
+                    continue
+                waiting.remove(k)
+                resources.acquire(needs[k])
+                if k in blocked:
+                    for n in chain.from_iterable(self.names[i] for i in jobs[k]):
+                        self.plugin.resource_waits[n] = (now - blocked[k], sorted(needs[k]))
+                statuses = {}
+                if snapshot:
+                    for i in jobs[k]:
+                        statuses.update(self.snapshot(i))
+                running[k] = pool.apply_async(_run_units, (jobs[k], statuses))
+            done = [k for k, outcome in running.items() if outcome.ready()]
+            while running and not done:
+                next(iter(running.values())).wait(0.01)
+                done = [k for k, outcome in running.items() if outcome.ready()]
+            for k in done:
+                outcomes[k] = running.pop(k).get()
+                resources.release(needs[k])
+            while replayed in outcomes:
+                self.merge(outcomes.pop(replayed), result)
+                replayed += 1
+        # Only left when the run was stopped before all jobs started
+        for k in sorted(outcomes):
+            self.merge(outcomes[k], result)
+
+    def merge(self, outcome, result):
+        """Take over what run_units returned in a worker"""
+        events, timings, profile = outcome
+        self.replay(events, result)
+        # Replaying takes no time, keep the time the test took in the worker
+        self.plugin.timings.update(timings)
+        if profile:
+            self.plugin.profile.merge(profile)
+
+    def run_units(self, indexes, statuses):
+        """Run units in a worker and return the recorded events, durations and profile"""
+        # The outcomes are journaled when they are replayed
+        self.plugin.journal = None
+        self.plugin.timings = {}
+        if nosedep.hook_profile is not None:
+            nosedep.hook_profile = self.plugin.profile = HookProfile()
+        for name, status in statuses.items():
+            self.plugin.record_status(name, status)
+        recorder = RecordingResult()
+        self.plugin.results = recorder
+        for index in indexes:
+            self.units[index](recorder)
+        profile = nosedep.hook_profile
+        return recorder.events, self.plugin.timings, profile and profile.stats()
+
+    def replay(self, events, result):
+        """Report the events recorded in a worker to the real result"""
+        proxy_factory = ResultProxyFactory(self.plugin.conf)
+        proxies = {}
+        for kind, test, detail in events:
+            if test not in proxies:
+                proxies[test] = proxy_factory(result, test)
+            proxy = proxies[test]
+            if kind == 'start':
+                proxy.startTest(test)
+            elif kind == 'stop':
+                proxy.stopTest(test)
+            elif kind == 'success':
+                proxy.addSuccess(test)
+            elif kind == 'failure':
+                proxy.addFailure(test, (RemoteFailure, RemoteFailure(detail), None))
+            elif kind == 'error':
+                proxy.addError(test, (RemoteError, RemoteError(detail), None))
+            elif kind == 'skip':
+                proxy.addSkip(test, detail)
+
+
+# Fork at a passed test once this many independent branches depend on it
+fanout_branches = 2
+
+
+class FanoutRunner(ParallelRunner):
+    """Runs the units in the main process, forking where the plan fans out
+
+    After a unit passes that at least `fanout_branches` independent branches
+    of the remaining units depend on with 'after', a pool is forked and each
+    branch runs in one of the children. The children start with everything
+    the passed tests built in memory, shared copy-on-write, so an expensive
+    prerequisite runs once. The outcomes are replayed into the result as
+    each branch is done, and the other units continue in the main process.
+    """
+
+    def __init__(self, plugin, tests, processes):
+        super(FanoutRunner, self).__init__(plugin, tests, processes)
+        owner = {}
+        for i, names in enumerate(self.names):
+            for n in names:
+                owner[n] = i
+        # The units that depend on each unit with 'after'
+        self.dependents = defaultdict(set)
+        for i, names in enumerate(self.names):
+            for n in names:
+                for d in dependencies.get(n, ()):
+                    if d in owner and owner[d] != i:
+                        self.dependents[owner[d]].add(i)
+
+    def calculate_levels(self):
+        return []
+
+    def run(self, result):
+        global _runner
+        _runner = self
+        remaining = list(range(len(self.units)))
+        try:
+            while remaining and not result.shouldStop:
+                index = remaining.pop(0)
+                self.units[index](result)
+                branches = self.branches(index, remaining)
+                if len(branches) >= fanout_branches:
+                    forked = set(chain.from_iterable(branches))
+                    remaining = [i for i in remaining if i not in forked]
+                    self.run_branches(branches, result)
+        finally:
+            _runner = None
+
+    def branches(self, index, remaining):
+        """The groups of remaining units that only depend on each other and a passed unit"""
+        if len(self.dependents[index]) < fanout_branches:
+            return []
+        statuses = self.plugin.statuses
+        if not all(statuses.get(n) == PASSED for n in self.names[index]):
+            return []
+        graph = unit_graph([self.names[i] for i in remaining])
+        components = [[remaining[k] for k in c] for c in connected_components(graph)]
+        return [c for c in components if self.dependents[index].intersection(c)]
+
+    def run_branches(self, branches, result):
+        pool = fork_pool(min(self.processes, len(branches)))
+        if pool is None:
+            for i in chain.from_iterable(branches):
+                if result.shouldStop:
+                    break
+                self.units[i](result)
+            return
+        try:
+            # The children are forked after the prerequisites ran, they know their outcome
+            self.run_jobs(pool, min(self.processes, len(branches)), branches, result,
+                          snapshot=False)
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class LockedResult(object):
+    """Result shared by threads, each call holds the lock
+
+    Results keep the state of the test being reported from startTest to its
+    outcome, like whether its description was written. So startTest is held
+    back in the thread and reported under the same lock as the next call,
+    which makes the report of each test whole while the test itself runs
+    without the lock.
+    """
+
+    def __init__(self, result, lock):
+        self.result = result
+        self.lock = lock
+        self.local = threading.local()
+
+    def startTest(self, test):
+        self.local.started = test
+
+    def __getattr__(self, name):
+        value = getattr(self.result, name)
+        if not callable(value):
+            return value
+
+        def locked(*args, **kwargs):
+            with self.lock:
+                started = getattr(self.local, 'started', None)
+                if started is not None:
+                    self.local.started = None
+                    self.result.startTest(started)
+                return value(*args, **kwargs)
+        return locked
+
+    @property
+    def shouldStop(self):
+        return self.result.shouldStop
+
+    @shouldStop.setter
+    def shouldStop(self, value):
+        self.result.shouldStop = value
+
+
+class ThreadStream(object):
+    """Output stream that keeps what each thread writes until it releases it
+
+    The verbose output of a test is written in parts as it starts and ends,
+    buffering keeps these parts together when tests run in threads.
+    """
+
+    def __init__(self, stream, lock):
+        self.stream = stream
+        self.lock = lock
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self):
+        self.local.parts = []
+
+    def release(self):
+        parts, self.local.parts = self.local.parts, None
+        with self.lock:
+            self.stream.write(''.join(parts))
+            self.stream.flush()
+
+    def write(self, text):
+        parts = getattr(self.local, 'parts', None)
+        if parts is None:
+            self.stream.write(text)
+        else:
+            parts.append(text)
+
+    def writeln(self, text=None):
+        if text:
+            self.write(text)
+        self.write('\n')
+
+    def flush(self):
+        if getattr(self.local, 'parts', None) is None:
+            self.stream.flush()
+
+
+class ThreadRunner(ParallelRunner):
+    """Runs the units in up to `processes` threads as soon as they are ready
+
+    A unit is started when the units it depends on are done and its resources
+    are free, so tests that wait for I/O overlap while sharing the clients
+    and state of this process. Suites with fixtures are units, all their
+    tests run in one thread. The result is shared through a LockedResult and
+    the output of each unit is written as a whole when it is done.
+    """
+
+    def __init__(self, plugin, tests, processes):
+        super(ThreadRunner, self).__init__(plugin, tests, processes)
+        self.stream = None
+
+    def calculate_levels(self):
+        return []
+
+    def run(self, result):
+        scheduler = UnitScheduler(unit_graph(self.names))
+        needs = [self.needs([i]) for i in range(len(self.units))]
+        resources = ResourcePool(self.plugin.resource_limits, needs)
+        shared = LockedResult(result, self.plugin.lock)
+        stream = getattr(result, 'stream', None)
+        if stream is not None:
+            self.stream = result.stream = ThreadStream(stream, self.plugin.lock)
+        finished = Queue()
+        running, blocked = 0, {}
+        try:
+            while not result.shouldStop:
+                now = time.time()
+                held = []
+                index = scheduler.pop()
+                while index is not None and running < self.processes:
+                    if not resources.fits(needs[index]):
+                        blocked.setdefault(index, now)
+                        held.append(index)
+                    else:
+                        resources.acquire(needs[index])
+                        if index in blocked:
+                            for n in self.names[index]:
+                                self.plugin.resource_waits[n] = (now - blocked[index],
+                                                                 sorted(needs[index]))
+                        thread = threading.Thread(target=self.run_unit,
+                                                  args=(index, shared, finished))
+                        thread.daemon = True
+                        thread.start()
+                        running += 1
+                    index = scheduler.pop()
+                if index is not None:
+                    held.append(index)
+                for index in held:
+                    scheduler.push(index)
+                if not running:
+                    break
+                index = finished.get()
+                running -= 1
+                resources.release(needs[index])
+                scheduler.done(index)
+            while running:
+                finished.get()
+                running -= 1
+            if not result.shouldStop:
+                for index in scheduler.never_ready():
+                    self.units[index](result)
+        finally:
+            if stream is not None:
+                result.stream = stream
+            self.stream = None
+
+    def run_unit(self, index, result, finished):
+        """Run a unit in a thread and write its output when it is done"""
+        if self.stream is not None:
+            self.stream.capture()
+        try:
+            self.units[index](result)
+        finally:
+            if self.stream is not None:
+                self.stream.release()
+            finished.put(index)
+
+
+class AsyncRunner(LazySuite):
+    """Runs the coroutine tests that are ready concurrently on one event loop
+
+    A unit is ready when the units it depends on are done. Ready tests of
+    coroutine functions decorated with depends are started as tasks, up to
+    `limit` at a time, and the outcome of each task is reported as soon as it
+    completes, which makes the tests that depend on it ready. Other units run
+    as usual when they are ready, and the loop waits while they do.
+    """
+
+    def __init__(self, plugin, tests, limit):
+        self.plugin = plugin
+        self.limit = limit
+        self.units = list(split_units(tests))
+        self.names = [unit_names(u) for u in self.units]
+        super(AsyncRunner, self).__init__(self.units)
+
+    def coroutine(self, index):
+        """The coroutine function of a unit if it can run on the loop, else None"""
+        case = getattr(self.units[index], 'test', None)
+        if not isinstance(case, FunctionTestCase) or case.setUpFunc or case.tearDownFunc:
+            return None
+        coroutine = getattr(case.test, 'nosedep_coroutine', None)
+        name = self.names[index][0]
+        if coroutine is None or self.plugin.dependency_failed(name) or \
+                self.plugin.dependency_ran(name):
+            # Skipped or errored by beforeTest
+            return None
+        return coroutine
+
+    def run(self, result):
+        scheduler = UnitScheduler(unit_graph(self.names))
+        loop = asyncio.new_event_loop()
+        running = {}
+        try:
+            while not result.shouldStop:
+                full = []
+                index = scheduler.pop()
+                while index is not None and not result.shouldStop:
+                    coroutine = self.coroutine(index)
+                    if coroutine is None:
+                        self.units[index](result)
+                        scheduler.done(index)
+                    elif len(running) >= self.limit:
+                        full.append(index)
+                    else:
+                        task = loop.create_task(coroutine(*self.units[index].test.arg))
+                        running[task] = index, time.time()
+                    index = scheduler.pop()
+                for index in full:
+                    scheduler.push(index)
+                if not running:
+                    break
+                finished, _ = loop.run_until_complete(
+                    asyncio.wait(list(running), return_when=asyncio.FIRST_COMPLETED))
+                for task in sorted(finished, key=lambda t: running[t][0]):
+                    index, started = running.pop(task)
+                    self.report(index, task, time.time() - started, result)
+                    scheduler.done(index)
+            if not result.shouldStop:
+                for index in scheduler.never_ready():
+                    self.units[index](result)
+        finally:
+            for task in running:
+                task.cancel()
+            if running:
+                loop.run_until_complete(asyncio.wait(list(running)))
+            loop.close()
+
+    def report(self, index, task, elapsed, result):
+        """Report the outcome of a completed task through the test it belongs to"""
+        case = self.units[index].test
+        original = case.test
+        exception = task.exception()
+
+        @wraps(original)
+        def outcome(*args):
+            if exception is not None:
+                raise exception
+        case.test = outcome
+        try:
+            self.units[index](result)
+        finally:
+            case.test = original
+        name = self.names[index][0]
+        if name in self.plugin.timings:
+            # Keep the time the coroutine ran, not the time of the replay
+            self.plugin.timings[name] = elapsed
@@ -0,0 +1,218 @@
+"""The daemon behind ``python -m nosedep_daemon serve``
+
+It runs nose for the clients of nosedep_daemon in this process, so that the
+test modules, the dependency registry and the plan are kept between runs.
+"""
+import importlib
+import inspect
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+from nose.core import TestProgram
+
+from nosedep import (NoseDep, _module_classes, declarations, is_within, module_file,
+                     rebuild_registry)
+
+# Modules that are never loaded again, __main__ is the one serving
+own_modules = ('__main__', 'nosedep', 'nosedep_runners', 'nosedep_server', 'nosedep_daemon')
+
+
+def file_stamp(file_name):
+    """Modification time and size of a file, None if it is gone"""
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+class ForwardedStream(object):
+    """File-like object that sends what is written to the current client"""
+    encoding = 'utf-8'
+
+    def __init__(self, name, fallback):
+        self.name = name
+        self.fallback = fallback
+        self.send = None
+
+    def write(self, text):
+        if not text:
+            return
+        if self.send is None:
+            self.fallback.write(text)
+        else:
+            self.send({self.name: text})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class Daemon(object):
+    """Runs nose for clients on a Unix socket, keeping the tests loaded in between
+
+    The test modules, the dependency registry and the plan stay in memory.
+    Before each run the modules below the directory whose files changed are
+    loaded again, together with the modules that use what they define. The
+    registry is only rebuilt, and the plan only computed again, when that
+    changes what the modules declare with depends.
+
+    Each request is a JSON line with the arguments for nose, the working
+    directory and the NOSE_ variables of the client. The daemon answers with
+    JSON lines holding output for stdout or stderr and finally the exit code.
+    """
+
+    def __init__(self, socket_file, directory):
+        self.socket_file = socket_file
+        self.directory = os.path.realpath(directory)
+        self.stamps = {}
+        self.stdout = ForwardedStream('stdout', sys.stdout)
+        self.stderr = ForwardedStream('stderr', sys.stderr)
+
+    def serve(self):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(self.socket_file):
+            try:
+                server.connect(self.socket_file)
+            except socket.error:
+                # Left behind by a daemon that was killed
+                os.remove(self.socket_file)
+            else:
+                server.close()
+                raise ValueError("A daemon is already serving {}".format(self.socket_file))
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_file)
+        server.listen(5)
+        try:
+            serving = True
+            while serving:
+                conn, _ = server.accept()
+                try:
+                    serving = self.handle(conn)
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            os.remove(self.socket_file)
+
+    def handle(self, conn):
+        """Answer one request, returns False when asked to stop"""
+        line = conn.makefile('rb').readline()
+        if not line:
+            # Only checking whether a daemon is running
+            return True
+        request = json.loads(line.decode('utf-8'))
+
+        def send(message):
+            conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        if request.get('stop'):
+            send({'exit': 0})
+            return False
+        if os.path.realpath(request['cwd']) != self.directory:
+            send({'stderr': "nosedep daemon serves {}, not {}\n".format(
+                self.directory, request['cwd'])})
+            send({'exit': 2})
+            return True
+        self.stdout.send = self.stderr.send = send
+        try:
+            code = self.run(request['argv'], request.get('env', {}))
+        finally:
+            self.stdout.send = self.stderr.send = None
+        send({'exit': code})
+        return True
+
+    def run(self, argv, env):
+        """Run nose like nosetests would, returning the exit code"""
+        self.reload()
+        started = time.time()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+        try:
+            program = TestProgram(argv=['nosetests'] + argv, env=env, exit=False,
+                                  addplugins=[NoseDep()])
+            return 0 if program.success else 1
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            sys.stderr.write('{}\n'.format(e.code))
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            self.stamp_imported(started)
+
+    def stamp_imported(self, started):
+        """Stamp the modules that a run imported
+
+        The stamp is only known to be the one of the imported file when the
+        file did not change since the run started. Otherwise the module gets
+        no stamp and is loaded again before the next run.
+        """
+        for name, file_name in self.modules().items():
+            if name not in self.stamps:
+                stamp = file_stamp(file_name)
+                # File systems store modification times coarsely
+                self.stamps[name] = stamp if stamp and stamp[0] < started - 2 else None
+
+    def modules(self):
+        """The source files of the loaded modules below the directory, by name
+
+        The modules of nosedep itself are left out, in case the directory
+        holds them, since the daemon is running them.
+        """
+        files = {}
+        for name, module in list(sys.modules.items()):
+            file_name = module_file(module)
+            if file_name and name not in own_modules and is_within(file_name, self.directory):
+                files[name] = file_name
+        return files
+
+    def reload(self):
+        """Load the modules again whose files changed since they were loaded"""
+        modules = self.modules()
+        changed = set(name for name, file_name in modules.items()
+                      if name in self.stamps and file_stamp(file_name) != self.stamps[name])
+        # Modules holding objects of a changed module would keep the old ones
+        users = True
+        while users:
+            users = set(name for name in modules if name not in changed and any(
+                getattr(value, '__module__', None) in changed or
+                (inspect.ismodule(value) and value.__name__ in changed)
+                for value in list(vars(sys.modules[name]).values())))
+            changed.update(users)
+        # What is known about the classes of the files that changed, or that
+        # are not loaded and so may have changed unnoticed, is found again
+        loaded = dict((os.path.splitext(f)[0], name) for name, f in modules.items())
+        for file_name in list(_module_classes):
+            name = loaded.get(os.path.splitext(file_name)[0])
+            if name is None or name in changed:
+                del _module_classes[file_name]
+        if not changed:
+            return
+        old = dict((name, declarations.pop(name, [])) for name in changed)
+        for name in changed:
+            del sys.modules[name]
+            self.stamps.pop(name, None)
+        for name in sorted(changed):
+            # Taken first, a change while importing is found by the next run
+            stamp = file_stamp(modules[name])
+            try:
+                importlib.import_module(name)
+            except Exception:
+                # Gone or broken, the run reports it if the module is needed
+                continue
+            self.stamps[name] = stamp
+        if any(declarations.get(name, []) != old[name] for name in changed):
+            rebuild_registry()
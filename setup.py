@@ -9,7 +9,7 @@ setup_args = dict(
     description='Nose test dependency support',
     long_description=open('README.md').read(),
     license='MIT',
-    py_modules=['nosedep'],
+    py_modules=['nosedep', 'nosedep_daemon', 'nosedep_runners', 'nosedep_server'],
     zip_safe=False,
     entry_points={
         'nose.plugins.0.10': [
@@ -0,0 +1,34 @@
+# Python 3 only, the name keeps it out of the directory runs
+import asyncio
+
+from nosedep import depends
+
+
+@depends(after='test_aio_fail')
+async def test_aio_after_fail():
+    pass
+
+
+@depends(after='test_aio_first')
+async def test_aio_after_first():
+    await asyncio.sleep(0.1)
+
+
+@depends(priority=50)
+async def test_aio_slow():
+    await asyncio.sleep(0.4)
+
+
+def test_aio_sync():
+    pass
+
+
+@depends(priority=10)
+async def test_aio_fail():
+    await asyncio.sleep(0.05)
+    assert False
+
+
+@depends(priority=10)
+async def test_aio_first():
+    await asyncio.sleep(0.15)
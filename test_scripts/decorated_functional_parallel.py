@@ -0,0 +1,24 @@
+from nosedep import depends
+
+
+def test_dfpar_a():
+    pass
+
+
+@depends(after='test_dfpar_a')
+def test_dfpar_b():
+    raise AssertionError("Fails in a worker")
+
+
+@depends(after='test_dfpar_b')
+def test_dfpar_c():
+    pass
+
+
+@depends(after='test_dfpar_a')
+def test_dfpar_d():
+    pass
+
+
+def test_dfpar_e():
+    pass
@@ -0,0 +1,47 @@
+import unittest
+
+from nosedep import depends
+
+
+class TestDfixA(unittest.TestCase):
+    def test_dfix_fail(self):
+        assert False
+
+
+class TestDfixDoomed(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        raise Exception('Fixture of a skipped class ran')
+
+    @depends(after='test_dfix_fail')
+    def test_dfix_a(self):
+        pass
+
+    @depends(after='test_dfix_a')
+    def test_dfix_b(self):
+        pass
+
+
+class TestDfixMissing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        raise Exception('Fixture of an errored class ran')
+
+    @depends(after='test_dfix_missing')
+    def test_dfix_c(self):
+        pass
+
+
+class TestDfixPartial(unittest.TestCase):
+    setup_calls = 0
+
+    @classmethod
+    def setUpClass(cls):
+        cls.setup_calls += 1
+
+    @depends(after='test_dfix_fail')
+    def test_dfix_d(self):
+        pass
+
+    def test_dfix_e(self):
+        assert self.setup_calls == 1
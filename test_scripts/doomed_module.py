@@ -0,0 +1,19 @@
+import unittest
+
+from nosedep import depends
+
+
+def setup_module():
+    raise Exception('Fixture of an errored module ran')
+
+
+class TestDmodA(unittest.TestCase):
+    @depends(after='test_dmod_missing')
+    def test_dmod_a(self):
+        pass
+
+
+class TestDmodB(unittest.TestCase):
+    @depends(after='test_dmod_a')
+    def test_dmod_b(self):
+        pass
@@ -0,0 +1,39 @@
+from nosedep import depends
+
+# Built by test_fan_root, the tests depending on it only read it
+state = {}
+# The tests that ran in this process
+ran = []
+
+
+def test_fan_z():
+    ran.append('test_fan_z')
+
+
+def test_fan_root():
+    state['data'] = list(range(1000))
+    ran.append('test_fan_root')
+
+
+@depends(after='test_fan_root')
+def test_fan_a():
+    assert state['data'][999] == 999
+    ran.append('test_fan_a')
+
+
+@depends(after='test_fan_a')
+def test_fan_a2():
+    assert state['data'][0] == 0
+    ran.append('test_fan_a2')
+
+
+@depends(after='test_fan_root')
+def test_fan_b():
+    assert len(state['data']) == 1000
+    ran.append('test_fan_b')
+
+
+@depends(after='test_fan_root')
+def test_fan_c():
+    assert state['data'][500] == 500
+    ran.append('test_fan_c')
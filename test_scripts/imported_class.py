@@ -0,0 +1 @@
+from test_scripts.simple import TestSimple
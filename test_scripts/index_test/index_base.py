@@ -0,0 +1,6 @@
+def test_idx_base():
+    pass
+
+
+def test_idx_other():
+    pass
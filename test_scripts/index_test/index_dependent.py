@@ -0,0 +1,10 @@
+from nosedep import depends
+
+
+@depends(after='test_idx_base')
+def test_idx_dep():
+    pass
+
+
+def test_idx_free():
+    pass
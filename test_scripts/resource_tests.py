@@ -0,0 +1,31 @@
+import os
+import tempfile
+import time
+
+from nosedep import depends
+
+# Exists while a test holds the database, the workers share the parent process
+lock_file = os.path.join(tempfile.gettempdir(), 'nosedep-db-{}'.format(os.getppid()))
+
+
+def use_db():
+    fd = os.open(lock_file, os.O_CREAT | os.O_EXCL)
+    try:
+        time.sleep(0.2)
+    finally:
+        os.close(fd)
+        os.remove(lock_file)
+
+
+@depends(resources='db')
+def test_res_a():
+    use_db()
+
+
+@depends(resources=['db', 'mem:1G'])
+def test_res_b():
+    use_db()
+
+
+def test_res_c():
+    time.sleep(0.1)
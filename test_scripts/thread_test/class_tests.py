@@ -0,0 +1,16 @@
+import threading
+import time
+
+
+class TestThrFixture(object):
+    @classmethod
+    def setup_class(cls):
+        cls.thread = threading.current_thread()
+
+    def test_thr_same_1(self):
+        time.sleep(0.1)
+        assert threading.current_thread() is self.thread
+
+    def test_thr_same_2(self):
+        time.sleep(0.1)
+        assert threading.current_thread() is self.thread
@@ -0,0 +1,28 @@
+import time
+
+from nosedep import depends
+
+
+def test_thr_root():
+    time.sleep(0.1)
+
+
+@depends(after='test_thr_root')
+def test_thr_a():
+    time.sleep(0.2)
+
+
+@depends(after='test_thr_root')
+def test_thr_b():
+    time.sleep(0.3)
+
+
+@depends(after='test_thr_root')
+def test_thr_fail():
+    time.sleep(0.05)
+    assert False
+
+
+@depends(after='test_thr_fail')
+def test_thr_skip():
+    pass
@@ -1,19 +1,38 @@
 #!/usr/bin/env python
+import json
+import optparse
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from nose.config import Config
 from nose.plugins import PluginTester
+from nose.plugins import multiprocess
 from nose.plugins.collect import CollectOnly
-from nose.plugins.skip import Skip
+from nose.plugins.skip import Skip, SkipTest
 from nose.plugins.xunit import Xunit
-from nose.tools import assert_in, eq_
+from nose.tools import assert_in, eq_, ok_
 
 try:
     from nose.tools import assert_raises_regex
 except ImportError:
     # For python 2.7
     from nose.tools import assert_raises_regexp as assert_raises_regex
-from nosedep import NoseDep, depends
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+import nosedep
+import nosedep_daemon
+import nosedep_runners
+import nosedep_server
+from nosedep import DepLoader, NoseDep, depends, get_plan
 
 
 class NoseDepPluginTester(PluginTester, unittest.TestCase):
@@ -39,6 +58,10 @@ class NoseDepPluginTester(PluginTester, unittest.TestCase):
         assert_in("Ran {} test{} in".format(results, 's' if results > 1 else ''),
                   str(self.output))
 
+    def check_preview(self, expect):
+        eq_(expect, [line.strip() for line in self.output if line.strip()][:len(expect)])
+        assert_in("Ran 0 tests in", str(self.output))
+
 
 class TestUndecoratedFunctional(NoseDepPluginTester):
     suitepath = "test_scripts/undecorated_functional_tests.py:"
@@ -99,6 +122,16 @@ class TestSimpleDecorated(NoseDepPluginTester):
                     ' Required test \'test_simple_decorated_fail\' FAILED'])
 
 
+class TestImportedClass(NoseDepPluginTester):
+    suitepath = "test_scripts/imported_class.py:TestSimple"
+
+    def runTest(self):
+        # nose names the class after the module it is transplanted into
+        lines = [line.split(') ')[-1] for line in str(self.output).splitlines()]
+        eq_(['... FAIL', '... ok', '... SKIP'], lines[:3])
+        assert 'Ran 3 tests' in str(self.output)
+
+
 class TestSimpleCollect(NoseDepPluginTester):
     args = ['-v', '--collect-only']
     plugins = [NoseDep(), CollectOnly()]
@@ -110,6 +143,41 @@ class TestSimpleCollect(NoseDepPluginTester):
                     'test_simple_skip (test_scripts.simple.TestSimple) ... ok'])
 
 
+class TestPreview(NoseDepPluginTester):
+    args = ['-v', '--nosedep-preview']
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+
+    def runTest(self):
+        self.check_preview(['test_scripts.decorated_functional_tests.test_dft_f'
+                            '  level 0  priority 50  collected',
+                            'test_scripts.decorated_functional_tests.test_dft_b'
+                            '  level 0  priority 50  collected',
+                            'test_scripts.decorated_functional_tests.test_dft_e'
+                            '  level 0  priority 50  collected',
+                            'test_scripts.decorated_functional_tests.test_dft_a'
+                            '  level 1  priority 50  collected',
+                            'test_scripts.decorated_functional_tests.test_dft_c'
+                            '  level 1  priority 50  collected',
+                            'test_scripts.decorated_functional_tests.test_dft_d'
+                            '  level 2  priority 50  collected',
+                            'nosedep preview: 6 tests in 3 levels'])
+
+
+class TestPreviewSpecific(NoseDepPluginTester):
+    args = ['-v', '--collect-only', '--nosedep-preview']
+    plugins = [NoseDep(), CollectOnly()]
+    suitepath = "test_scripts/decorated_functional_tests.py:test_dft_d"
+
+    def runTest(self):
+        self.check_preview(['test_scripts.decorated_functional_tests.test_dft_b'
+                            '  level 0  priority 50  dependency of test_dft_a',
+                            'test_scripts.decorated_functional_tests.test_dft_a'
+                            '  level 1  priority 50  dependency of test_dft_d',
+                            'test_scripts.decorated_functional_tests.test_dft_d'
+                            '  level 2  priority 50  requested',
+                            'nosedep preview: 3 tests in 3 levels'])
+
+
 class TestSimpleSetupFailNoNosedep(NoseDepPluginTester):
     """Setup failure should not generate error in collect mode without nosedep
     (verify expectation)
@@ -221,6 +289,64 @@ class TestDecoratedFunctionalDepSkip(NoseDepPluginTester):
                     ' Required test \'test_dfds_e\' SKIPPED'])
 
 
+class TestRerunFailed(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_dep_skip.py:"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.results_file = os.path.join(self.directory, 'results')
+        self.args = ['-v', '--nosedep-failed', '--nosedep-results=' + self.results_file]
+        # The first run runs everything and stores the outcomes
+        self.plugins = [NoseDep(), Skip()]
+        super(TestRerunFailed, self).setUp()
+        self.plugins = [NoseDep(), Skip()]
+        super(TestRerunFailed, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestRerunFailed, self).tearDown()
+
+    def runTest(self):
+        # test_dfds_c passed and nothing depends on it. The skipped test_dfds_e
+        # is only run again since the dependency skipped test_dfds_f needs it.
+        self.check(['test_scripts.decorated_functional_dep_skip.test_dfds_b ... FAIL',
+                    'test_scripts.decorated_functional_dep_skip.test_dfds_e ... SKIP: skippington',
+                    'test_scripts.decorated_functional_dep_skip.test_dfds_a ... SKIP:'
+                    ' Required test \'test_dfds_b\' FAILED',
+                    'test_scripts.decorated_functional_dep_skip.test_dfds_d ... ERROR',
+                    'test_scripts.decorated_functional_dep_skip.test_dfds_f ... SKIP:'
+                    ' Required test \'test_dfds_e\' SKIPPED'])
+        eq_(['test_dfds_a', 'test_dfds_b', 'test_dfds_d', 'test_dfds_f'],
+            nosedep.Outcomes(self.results_file).rerun)
+
+
+class TestRerunFailedNotCollected(NoseDepPluginTester):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.results_file = os.path.join(self.directory, 'results')
+        self.args = ['-v', '--nosedep-failed', '--nosedep-results=' + self.results_file]
+        self.suitepath = "test_scripts/decorated_functional_dep_skip.py:"
+        self.plugins = [NoseDep(), Skip()]
+        super(TestRerunFailedNotCollected, self).setUp()
+        # The failed tests are in a module that is not given this time
+        self.suitepath = "test_scripts/decorated_functional_func.py:"
+        self.plugins = [NoseDep(), Skip()]
+        super(TestRerunFailedNotCollected, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestRerunFailedNotCollected, self).tearDown()
+
+    def runTest(self):
+        assert_in('Ran 0 tests in', str(self.output))
+        assert_in('nosedep failed: test_dfds_a, test_dfds_b, test_dfds_d, test_dfds_f of the '
+                  'last run not collected, so not run again', str(self.output))
+        assert_in('FAILED (errors=4)', str(self.output))
+        # They are still run again once their module is given
+        eq_(['test_dfds_a', 'test_dfds_b', 'test_dfds_d', 'test_dfds_f'],
+            nosedep.Outcomes(self.results_file).rerun)
+
+
 class TestDecoratedFunctionalFunc(NoseDepPluginTester):
     suitepath = "test_scripts/decorated_functional_func.py:"
 
@@ -248,6 +374,464 @@ class TestDecoratedFunctionalSpecificDep(NoseDepPluginTester):
                     'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
 
 
+class TestCachedDependencies(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:test_dft_d"
+    force = []
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.args = ['-v', '--nosedep-cache=' + os.path.join(self.directory, 'cache')]
+        # The first run fills the cache
+        self.plugins = [NoseDep(), Skip()]
+        super(TestCachedDependencies, self).setUp()
+        self.args += self.force
+        self.plugins = [NoseDep(), Skip()]
+        super(TestCachedDependencies, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestCachedDependencies, self).tearDown()
+
+    def runTest(self):
+        self.check(['test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+
+
+class TestCachedDependenciesForced(TestCachedDependencies):
+    force = ['--nosedep-cache-force']
+
+    def runTest(self):
+        self.check(['test_scripts.decorated_functional_tests.test_dft_b ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_a ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+
+
+class TestResultCacheKey(unittest.TestCase):
+    def test_changed_dependency(self):
+        nosedep.dependencies['run_test_cache_b'].add('run_test_cache_a')
+        try:
+            cache = nosedep.ResultCache(os.devnull)
+            cache.sources = {'run_test_cache_a': '1', 'run_test_cache_b': '2'}
+            cache.update({'run_test_cache_b': nosedep.PASSED})
+            self.assertTrue(cache.hit('run_test_cache_b'))
+            cache.sources['run_test_cache_a'] = '3'
+            self.assertFalse(cache.hit('run_test_cache_b'))
+            del cache.sources['run_test_cache_a']
+            eq_(None, cache.key('run_test_cache_b'))
+        finally:
+            nosedep.dependencies.pop('run_test_cache_b', None)
+
+
+class TestResume(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = os.path.join(self.directory, 'journal')
+        # A run that died while writing the outcome of test_dft_f
+        with open(self.journal, 'w') as f:
+            f.write('PASSED test_dft_b\nPASSED test_dft_a\nFAILED test_dft_e\nPASSED test_dft')
+        self.args = ['-v', '--nosedep-journal=' + self.journal, '--nosedep-resume']
+        super(TestResume, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestResume, self).tearDown()
+
+    def runTest(self):
+        self.check(['test_scripts.decorated_functional_tests.test_dft_f ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_c ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+        eq_([('test_dft_b', 'PASSED'), ('test_dft_a', 'PASSED'), ('test_dft_e', 'FAILED'),
+             ('test_dft_f', 'PASSED'), ('test_dft_c', 'PASSED'), ('test_dft_d', 'PASSED')],
+            nosedep.Journal.read(self.journal))
+        # The failure before the interruption still fails the run
+        assert_in('nosedep resume: test_dft_e FAILED in the interrupted run', str(self.output))
+        assert_in('FAILED (failures=1)', str(self.output))
+
+
+interrupted_tests = '''
+import os
+
+
+def test_a():
+    assert False
+
+
+def test_b():
+    if not os.path.isfile('resumed'):
+        open('resumed', 'w').close()
+        raise KeyboardInterrupt
+
+
+def test_c():
+    pass
+'''
+
+
+class TestResumeInterrupted(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'interrupted_tests.py'), 'w') as f:
+            f.write(interrupted_tests)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_tests(self, *args):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(nosedep.__file__)))
+        command = ['import nose, nosedep', 'nose.main(addplugins=[nosedep.NoseDep()])']
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.call([sys.executable, '-c', '; '.join(command), '-v',
+                                    '--with-nosedep', '--nosedep-journal=journal',
+                                    'interrupted_tests.py'] + list(args),
+                                   cwd=self.directory, env=env, stderr=devnull)
+
+    def runTest(self):
+        eq_(1, self.run_tests())
+        eq_([('test_a', 'FAILED')], nosedep.Journal.read(os.path.join(self.directory, 'journal')))
+        # Only test_b and test_c run, but test_a failed before the interruption
+        eq_(1, self.run_tests('--nosedep-resume'))
+        eq_([('test_a', 'FAILED'), ('test_b', 'PASSED'), ('test_c', 'PASSED')],
+            nosedep.Journal.read(os.path.join(self.directory, 'journal')))
+
+
+class TestJournal(unittest.TestCase):
+    def test_new_run_truncates(self):
+        directory = tempfile.mkdtemp()
+        try:
+            journal_file = os.path.join(directory, 'journal')
+            journal = nosedep.Journal(journal_file)
+            journal.write('test_a', nosedep.FAILED)
+            journal.close()
+            journal = nosedep.Journal(journal_file, truncate=False)
+            journal.write('test_b', nosedep.PASSED)
+            journal.close()
+            eq_([('test_a', 'FAILED'), ('test_b', 'PASSED')], nosedep.Journal.read(journal_file))
+            nosedep.Journal(journal_file).close()
+            eq_([], nosedep.Journal.read(journal_file))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestDurationOrder(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.durations = os.path.join(self.directory, 'durations')
+        with open(self.durations, 'w') as f:
+            json.dump({'version': 1, 'durations': {'test_dft_a': 1, 'test_dft_b': 1,
+                                                   'test_dft_c': 5, 'test_dft_d': 1,
+                                                   'test_dft_e': 10, 'test_dft_f': 1}}, f)
+        self.args = ['-v', '--nosedep-order=duration', '--nosedep-durations=' + self.durations]
+        super(TestDurationOrder, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestDurationOrder, self).tearDown()
+
+    def runTest(self):
+        # e and b are in the same level but the chain e, c takes longer than b, a, d
+        self.check(['test_scripts.decorated_functional_tests.test_dft_f ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_e ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_b ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_c ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_a ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+        # The history now has the durations of this run
+        durations = nosedep.DurationHistory(self.durations).durations
+        self.assertTrue(all(durations[n] < 1 for n in durations))
+
+
+class TestCriticalPaths(unittest.TestCase):
+    def test_paths(self):
+        graph = nosedep.DependencyGraph()
+        dependencies = nosedep.Edges(graph, nosedep.HARD)
+        dependencies['b'].add('a')
+        dependencies['c'].add('b')
+        dependencies['d'].add('a')
+        # d takes the average of the known durations
+        eq_({'a': 6.0, 'b': 5.0, 'c': 3.0, 'd': 2.0},
+            graph.critical_paths({'a': 1.0, 'b': 2.0, 'c': 3.0}))
+
+
+class TestShard(NoseDepPluginTester):
+    args = ['-v', '--nosedep-shard=1/3']
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+
+    def runTest(self):
+        # test_dft_d needs both test_dft_a and test_dft_b
+        self.check(['test_scripts.decorated_functional_tests.test_dft_b ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_a ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+        assert_in('nosedep shard 1/3: 3 tests (shards have 2 to 3 tests, imbalance 29%)',
+                  str(self.output))
+
+
+class TestShardDurations(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+    durations = {'test_dft_a': 1, 'test_dft_b': 1, 'test_dft_c': 5,
+                 'test_dft_d': 1, 'test_dft_e': 10, 'test_dft_f': 1}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.durations_file = os.path.join(self.directory, 'durations')
+        with open(self.durations_file, 'w') as f:
+            json.dump({'version': 1, 'durations': self.durations}, f)
+        self.args = ['-v', '--nosedep-shard=1/3', '--nosedep-durations=' + self.durations_file]
+        super(TestShardDurations, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestShardDurations, self).tearDown()
+
+    def runTest(self):
+        # test_dft_e takes the longest and has a shard of its own
+        self.check(['test_scripts.decorated_functional_tests.test_dft_e ... ok'])
+        assert_in('nosedep shard 1/3: 1 tests, 10.0s', str(self.output))
+
+
+class TestShardLocalDurations(NoseDepPluginTester):
+    durations = TestShardDurations.durations
+
+    def setUp(self):
+        # The default durations file of --nosedep-order=duration is local to
+        # each node, so it is not used to balance the shards
+        self.directory = tempfile.mkdtemp()
+        self.suitepath = os.path.abspath("test_scripts/decorated_functional_tests.py") + ':'
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        with open('.nosedep-durations', 'w') as f:
+            json.dump({'version': 1, 'durations': self.durations}, f)
+        self.args = ['-v', '--nosedep-shard=1/3', '--nosedep-order=duration']
+        super(TestShardLocalDurations, self).setUp()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+        super(TestShardLocalDurations, self).tearDown()
+
+    def runTest(self):
+        assert_in('nosedep shard 1/3: 3 tests (shards have 2 to 3 tests, imbalance 29%)',
+                  str(self.output))
+
+
+class TestPlanInOut(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.plan_file = os.path.join(self.directory, 'plan')
+        self.args = ['-v', '--nosedep-shard=1/3', '--nosedep-plan-out=' + self.plan_file]
+        self.plugins = [NoseDep(), Skip()]
+        super(TestPlanInOut, self).setUp()
+        self.args = ['-v', '--nosedep-shard=1/3', '--nosedep-plan-in=' + self.plan_file]
+        self.plugins = [NoseDep(), Skip()]
+        # The stored order is used instead of resolving the dependencies again
+        self.resolved = []
+        calculate_dependencies = NoseDep.calculate_dependencies
+        NoseDep.calculate_dependencies = staticmethod(lambda *args: self.resolved.append(args))
+        nosedep.invalidate_plan()
+        try:
+            super(TestPlanInOut, self).setUp()
+        finally:
+            NoseDep.calculate_dependencies = staticmethod(calculate_dependencies)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TestPlanInOut, self).tearDown()
+
+    def runTest(self):
+        ok_(self.plugins[0].plan_loaded)
+        eq_([], self.resolved)
+        self.check(['test_scripts.decorated_functional_tests.test_dft_b ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_a ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_d ... ok'])
+
+
+class TestJsonStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.durations_file = os.path.join(self.directory, 'durations')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def stored(self, text):
+        with open(self.durations_file, 'w') as f:
+            f.write(text)
+        return nosedep.DurationHistory(self.durations_file).durations
+
+    def test_round_trip(self):
+        history = nosedep.DurationHistory(self.durations_file)
+        history.durations['test_a'] = 1.5
+        history.save()
+        eq_({'test_a': 1.5}, nosedep.DurationHistory(self.durations_file).durations)
+
+    def test_unusable(self):
+        eq_({}, nosedep.DurationHistory(self.durations_file).durations)
+        eq_({}, self.stored('{"version": 1, "durations": '))
+        eq_({}, self.stored('{"version": 2, "durations": {"test_a": 1}}'))
+        eq_({}, self.stored('{"version": 1}'))
+        eq_({}, self.stored('[1]'))
+
+
+class TestPlanFile(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source = os.path.join(self.directory, 'test_source.py')
+        with open(self.source, 'w') as f:
+            f.write('def test_a():\n    pass\n')
+        self.plan_file = os.path.join(self.directory, 'plan')
+        self.settings = {'ordering': nosedep.LEVELS, 'tests': [], 'shard': None}
+        nosedep.PlanFile(self.plan_file).save(self.settings, [self.source], ['test_a'], None, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_valid(self):
+        plan_file = nosedep.PlanFile(self.plan_file)
+        ok_(plan_file.valid(self.settings, [self.source]))
+        eq_(['test_a'], plan_file.data['order'])
+
+    def test_settings_changed(self):
+        settings = dict(self.settings, ordering=nosedep.HEAP)
+        ok_(not nosedep.PlanFile(self.plan_file).valid(settings, [self.source]))
+
+    def test_files_changed(self):
+        ok_(not nosedep.PlanFile(self.plan_file).valid(self.settings, []))
+
+    def test_touched(self):
+        # A fresh checkout has other times but the same content
+        os.utime(self.source, (0, 0))
+        ok_(nosedep.PlanFile(self.plan_file).valid(self.settings, [self.source]))
+        with open(self.source, 'w') as f:
+            f.write('def test_a():\n    fail\n')
+        ok_(not nosedep.PlanFile(self.plan_file).valid(self.settings, [self.source]))
+
+
+class TestProfile(NoseDepPluginTester):
+    suitepath = "test_scripts/decorated_functional_tests.py:"
+    options = []
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.profile_file = os.path.join(self.directory, 'profile')
+        self.args = ['-v', '--nosedep-profile=' + self.profile_file] + self.options
+        self.plugins = [NoseDep(), Skip()]
+        # The plan may still be cached by an earlier test
+        nosedep.invalidate_plan()
+        super(TestProfile, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        nosedep.hook_profile = None
+        super(TestProfile, self).tearDown()
+
+    def runTest(self):
+        with open(self.profile_file) as f:
+            hooks = json.load(f)['hooks']
+        eq_(hooks, self.plugins[0].profile.stats())
+        for name in ('prepareTestLoader', 'prepareTest', 'prepare_tests_on_levels',
+                     'calculate_dependencies', 'orderTests', 'testName'):
+            assert_in(name, hooks)
+        for name in ('beforeTest', 'startTest', 'stopTest', 'addSuccess'):
+            eq_(6, hooks[name]['count'])
+            eq_(6, sum(count for _, count in hooks[name]['histogram']))
+
+
+class TestProfileThreads(TestProfile):
+    """Hooks running at the same time in several threads are all counted"""
+    suitepath = "test_scripts/thread_test:"
+    options = ['--nosedep-threads=4']
+
+    def runTest(self):
+        hooks = self.plugins[0].profile.stats()
+        for name in ('beforeTest', 'startTest', 'stopTest'):
+            eq_(7, hooks[name]['count'])
+        eq_(5, hooks['addSuccess']['count'])
+
+
+class TestHookProfile(unittest.TestCase):
+    def test_histogram(self):
+        profile = nosedep.HookProfile()
+        for elapsed in (0.0000005, 0.000003, 0.000003, 0.002):
+            profile.record('beforeTest', elapsed)
+        stats = profile.stats()['beforeTest']
+        eq_(4, stats['count'])
+        eq_([[1, 1], [4, 2], [2048, 1]], stats['histogram'])
+
+    def test_merge(self):
+        profile, other = nosedep.HookProfile(), nosedep.HookProfile()
+        profile.record('beforeTest', 0.000003)
+        other.record('beforeTest', 0.000003)
+        other.record('addSuccess', 0.001)
+        profile.merge(other.stats())
+        eq_(2, profile.stats()['beforeTest']['count'])
+        eq_([[4, 2]], profile.stats()['beforeTest']['histogram'])
+        eq_([[1024, 1]], profile.stats()['addSuccess']['histogram'])
+
+    def test_recursion(self):
+        nosedep.hook_profile = nosedep.HookProfile()
+        try:
+            @nosedep.profiled('count_down')
+            def count_down(n):
+                return count_down(n - 1) if n else 0
+            count_down(3)
+            eq_(1, nosedep.hook_profile.stats()['count_down']['count'])
+        finally:
+            nosedep.hook_profile = None
+
+    def test_threads(self):
+        nosedep.hook_profile = nosedep.HookProfile()
+        entered, lock, all_entered = [], threading.Lock(), threading.Event()
+        try:
+            @nosedep.profiled('hook')
+            def hook():
+                with lock:
+                    entered.append(True)
+                    if len(entered) == 4:
+                        all_entered.set()
+                # All four calls are running at the same time
+                all_entered.wait(5)
+            threads = [threading.Thread(target=hook) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            eq_(4, nosedep.hook_profile.stats()['hook']['count'])
+        finally:
+            nosedep.hook_profile = None
+
+
+class TestPartition(unittest.TestCase):
+    def setUp(self):
+        # Two chains sharing part_a, and independent tests
+        for name, after in (('part_b', 'part_a'), ('part_c', 'part_b'), ('part_d', 'part_a')):
+            nosedep.dependencies[name].add(after)
+        self.names = ['part_a', 'part_b', 'part_c', 'part_d', 'part_e', 'part_f']
+
+    def tearDown(self):
+        for name in self.names:
+            nosedep.dependencies.pop(name, None)
+
+    def test_closed(self):
+        shards, loads = nosedep.partition(self.names, 3)
+        for tests in shards:
+            eq_(tests, nosedep.hard_closure(tests))
+        eq_(set(self.names), set.union(*shards))
+        eq_([len(tests) for tests in shards], loads)
+
+    def test_durations(self):
+        durations = {'part_a': 1, 'part_b': 1, 'part_c': 1, 'part_d': 1, 'part_e': 2, 'part_f': 3}
+        shards, loads = nosedep.partition(self.names, 2, durations)
+        eq_([{'part_a', 'part_b', 'part_c', 'part_d'}, {'part_e', 'part_f'}], shards)
+        eq_([4, 5], loads)
+
+    def test_deterministic(self):
+        eq_(nosedep.partition(self.names, 4), nosedep.partition(reversed(self.names), 4))
+
+
 class TestDecoratedFunctionalSpecificNoDep(NoseDepPluginTester):
     suitepath = "test_scripts/decorated_functional_tests.py:test_dft_f"
 
@@ -313,6 +897,564 @@ class TestDecoratedMethodSpecificDep(NoseDepPluginTester):
         self.check(['test_scripts.decorated_method_tests.TestNoseDecoratedMethod.test_cd_b ... ok'])
 
 
+class TestDoomedFixtures(NoseDepPluginTester):
+    """Fixtures of a class where no test can run should not run"""
+    suitepath = "test_scripts/doomed_fixtures.py:"
+
+    def runTest(self):
+        self.check(['test_dfix_fail (test_scripts.doomed_fixtures.TestDfixA) ... FAIL',
+                    'test_dfix_a (test_scripts.doomed_fixtures.TestDfixDoomed) ... SKIP:'
+                    ' Required test \'test_dfix_fail\' FAILED',
+                    'test_dfix_b (test_scripts.doomed_fixtures.TestDfixDoomed) ... SKIP:'
+                    ' Required test \'test_dfix_a\' SKIPPED',
+                    'test_dfix_c (test_scripts.doomed_fixtures.TestDfixMissing) ... ERROR',
+                    'test_dfix_e (test_scripts.doomed_fixtures.TestDfixPartial) ... ok',
+                    'test_dfix_d (test_scripts.doomed_fixtures.TestDfixPartial) ... SKIP:'
+                    ' Required test \'test_dfix_fail\' FAILED'])
+        assert_in("Exception: Required test 'test_dfix_missing' did not run", str(self.output))
+
+
+class TestDoomedModuleFixtures(NoseDepPluginTester):
+    """Fixtures of a module where no test can run should not run"""
+    suitepath = "test_scripts/doomed_module.py:"
+
+    def runTest(self):
+        self.check(['test_dmod_a (test_scripts.doomed_module.TestDmodA) ... ERROR',
+                    'test_dmod_b (test_scripts.doomed_module.TestDmodB) ... SKIP:'
+                    ' Required test \'test_dmod_a\' ERRORED'])
+        assert_in("Exception: Required test 'test_dmod_missing' did not run", str(self.output))
+
+
+class TestDecoratedFunctionalParallel(NoseDepPluginTester):
+    args = ['-v', '--nosedep-workers=2']
+    suitepath = "test_scripts/decorated_functional_parallel.py:"
+
+    def runTest(self):
+        self.check(['test_scripts.decorated_functional_parallel.test_dfpar_e ... ok',
+                    'test_scripts.decorated_functional_parallel.test_dfpar_a ... ok',
+                    'test_scripts.decorated_functional_parallel.test_dfpar_b ... FAIL',
+                    'test_scripts.decorated_functional_parallel.test_dfpar_d ... ok',
+                    'test_scripts.decorated_functional_parallel.test_dfpar_c ... SKIP:'
+                    ' Required test \'test_dfpar_b\' FAILED'])
+
+
+class TestResources(NoseDepPluginTester):
+    args = ['-v', '--nosedep-workers=3']
+    suitepath = "test_scripts/resource_tests.py:"
+
+    def runTest(self):
+        # test_res_a and test_res_b fail if they use the database at the same time
+        self.check(['test_scripts.resource_tests.test_res_a ... ok',
+                    'test_scripts.resource_tests.test_res_b ... ok',
+                    'test_scripts.resource_tests.test_res_c ... ok'])
+        assert_in("nosedep resource wait: test_res_b waited 0.", str(self.output))
+        assert_in("s for db, mem", str(self.output))
+
+
+class TestResourcePool(unittest.TestCase):
+    def test_parse(self):
+        eq_({'db': 1, 'mem': 4 * 2 ** 30, 'port': 2},
+            nosedep.parse_resources(['db', 'mem:4G', 'port:2']))
+        with assert_raises_regex(ValueError, r"Invalid resource 'mem:lots'"):
+            nosedep.parse_resources('mem:lots')
+
+    def test_limits(self):
+        pool = nosedep_runners.ResourcePool({'mem': 8}, [{'db': 1}, {'mem': 4}])
+        for need, fits in (({'db': 1}, True), ({'mem': 4}, True), ({'mem': 4}, True),
+                           ({'mem': 1}, False), ({'db': 1}, False)):
+            eq_(fits, pool.fits(need))
+            if fits:
+                pool.acquire(need)
+        pool.release({'mem': 4})
+        ok_(pool.fits({'mem': 4}))
+
+    def test_oversized(self):
+        # A job needing more than there is runs on its own
+        pool = nosedep_runners.ResourcePool({'mem': 8}, [])
+        ok_(pool.fits({'mem': 16}))
+        pool.acquire({'mem': 1})
+        ok_(not pool.fits({'mem': 16}))
+
+
+class TestFanout(NoseDepPluginTester):
+    args = ['-v', '--nosedep-fork=2']
+    suitepath = "test_scripts/fanout_tests.py:"
+
+    def runTest(self):
+        self.check(['test_scripts.fanout_tests.test_fan_z ... ok',
+                    'test_scripts.fanout_tests.test_fan_root ... ok',
+                    'test_scripts.fanout_tests.test_fan_a ... ok',
+                    'test_scripts.fanout_tests.test_fan_a2 ... ok',
+                    'test_scripts.fanout_tests.test_fan_b ... ok',
+                    'test_scripts.fanout_tests.test_fan_c ... ok'])
+        # The dependents ran in forked processes, with the state of test_fan_root
+        eq_(['test_fan_z', 'test_fan_root'], sys.modules['test_scripts.fanout_tests'].ran)
+
+
+class TestThreads(NoseDepPluginTester):
+    args = ['-v', '--nosedep-threads=4']
+    suitepath = "test_scripts/thread_test:"
+
+    def runTest(self):
+        # Reported as the tests finish, each output line is whole
+        prefix = 'test_scripts.thread_test.'
+        lines = [line.strip() for line in self.output if ' ... ' in line]
+        root = prefix + 'function_tests.test_thr_root ... ok'
+        fail = prefix + 'function_tests.test_thr_fail ... FAIL'
+        skip = (prefix + 'function_tests.test_thr_skip ... SKIP:'
+                ' Required test \'test_thr_fail\' FAILED')
+        a = prefix + 'function_tests.test_thr_a ... ok'
+        b = prefix + 'function_tests.test_thr_b ... ok'
+        eq_(sorted([root, fail, skip, a, b,
+                    prefix + 'class_tests.TestThrFixture.test_thr_same_1 ... ok',
+                    prefix + 'class_tests.TestThrFixture.test_thr_same_2 ... ok']), sorted(lines))
+        ok_(lines.index(root) < lines.index(fail) < lines.index(skip) < lines.index(a))
+
+
+class TestThreadSkipIndex(unittest.TestCase):
+    def test_others_skipped_since(self):
+        class ThreadSkips(unittest.TestCase):
+            def test_a(self):
+                pass
+            test_b = test_c = test_d = test_a
+
+        plugin = NoseDep()
+        plugin.threads = 2
+        plugin.results = unittest.TestResult()
+        first = ThreadSkips('test_a')
+        plugin.startTest(first)
+        plugin.results.addSkip(first, 'skipped')
+
+        def others():
+            # More skips than there are threads, added before test_a stops
+            for name in ('test_b', 'test_c', 'test_d'):
+                test = ThreadSkips(name)
+                plugin.startTest(test)
+                plugin.results.addSkip(test, 'skipped')
+                plugin.stopTest(test)
+        thread = threading.Thread(target=others)
+        thread.start()
+        thread.join()
+        plugin.stopTest(first)
+        eq_(dict((n, nosedep.SKIPPED) for n in ('test_a', 'test_b', 'test_c', 'test_d')),
+            plugin.statuses)
+
+
+class TestUnitScheduler(unittest.TestCase):
+    def test_release(self):
+        scheduler = nosedep.UnitScheduler({0: set(), 1: {0}, 2: set(), 3: {1, 2}})
+        eq_(0, scheduler.pop())
+        eq_(2, scheduler.pop())
+        eq_(None, scheduler.pop())
+        scheduler.done(2)
+        eq_(None, scheduler.pop())
+        scheduler.done(0)
+        eq_(1, scheduler.pop())
+        scheduler.push(1)
+        eq_(1, scheduler.pop())
+        scheduler.done(1)
+        eq_(3, scheduler.pop())
+        eq_([], scheduler.never_ready())
+
+    def test_cycle(self):
+        scheduler = nosedep.UnitScheduler({0: set(), 1: {2}, 2: {1}})
+        eq_(0, scheduler.pop())
+        scheduler.done(0)
+        eq_(None, scheduler.pop())
+        eq_([1, 2], scheduler.never_ready())
+
+
+class TestThreadStream(unittest.TestCase):
+    def test_buffered(self):
+        stream = nosedep_runners.ThreadStream(StringIO(), threading.Lock())
+        stream.write('main ')
+
+        def write(name):
+            stream.capture()
+            for part in (name, ' ... ', 'ok'):
+                stream.write(part)
+                time.sleep(0.01)
+            stream.writeln()
+            stream.release()
+        threads = [threading.Thread(target=write, args=(n,)) for n in ('a', 'b')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        lines = stream.stream.getvalue().splitlines()
+        eq_('main ', lines[0][:5])
+        eq_(['a ... ok', 'b ... ok'], sorted([lines[0][5:]] + lines[1:]))
+
+
+@unittest.skipIf(nosedep.asyncio is None, 'needs asyncio')
+class TestAsync(NoseDepPluginTester):
+    args = ['-v', '--nosedep-async=3']
+    suitepath = "test_scripts/coroutines.py:"
+
+    def runTest(self):
+        prefix = 'test_scripts.coroutines.'
+        # Reported as the coroutines complete, dependents start right after
+        self.check([prefix + 'test_aio_sync ... ok',
+                    prefix + 'test_aio_fail ... FAIL',
+                    prefix + 'test_aio_after_fail ... SKIP: Required test \'test_aio_fail\' FAILED',
+                    prefix + 'test_aio_first ... ok',
+                    prefix + 'test_aio_after_first ... ok',
+                    prefix + 'test_aio_slow ... ok'])
+
+
+@unittest.skipIf(nosedep.asyncio is None, 'needs asyncio')
+class TestAsyncOptions(unittest.TestCase):
+    def test_other_runner(self):
+        plugin = NoseDep()
+        parser = optparse.OptionParser()
+        plugin.options(parser, {})
+        options, _ = parser.parse_args(['--with-nosedep', '--nosedep-async=2',
+                                        '--nosedep-threads=2'])
+        config = Config(parser=parser)
+        with assert_raises_regex(ValueError, r'--nosedep-async can not be combined with '
+                                             r'--nosedep-threads'):
+            plugin.configure(options, config)
+
+
+@unittest.skipIf(nosedep.asyncio is None, 'needs asyncio')
+class TestAsyncSerial(NoseDepPluginTester):
+    suitepath = "test_scripts/coroutines.py:"
+
+    def runTest(self):
+        prefix = 'test_scripts.coroutines.'
+        self.check([prefix + 'test_aio_slow ... ok',
+                    prefix + 'test_aio_sync ... ok',
+                    prefix + 'test_aio_fail ... FAIL',
+                    prefix + 'test_aio_first ... ok',
+                    prefix + 'test_aio_after_fail ... SKIP: Required test \'test_aio_fail\' FAILED',
+                    prefix + 'test_aio_after_first ... ok'])
+
+
+class TestDecoratedFunctionalMultiprocess(NoseDepPluginTester):
+    args = ['-v', '--processes=2']
+    plugins = [NoseDep(), Skip(), multiprocess.MultiProcess()]
+    suitepath = "test_scripts/decorated_functional_dep_skip.py:"
+
+    def setUp(self):
+        # The plugins are not installed so the workers need to be told about them
+        multiprocess._instantiate_plugins = [NoseDep, Skip]
+        super(TestDecoratedFunctionalMultiprocess, self).setUp()
+
+    def tearDown(self):
+        multiprocess._instantiate_plugins = None
+        super(TestDecoratedFunctionalMultiprocess, self).tearDown()
+
+    def runTest(self):
+        # Groups finish in any order, but each group is ordered
+        lines = [line.strip() for line in self.output if ' ... ' in line]
+        prefix = 'test_scripts.decorated_functional_dep_skip.'
+        expected = [prefix + 'test_dfds_c ... ok',
+                    prefix + 'test_dfds_b ... FAIL',
+                    prefix + 'test_dfds_e ... SKIP: skippington',
+                    prefix + 'test_dfds_a ... SKIP: Required test \'test_dfds_b\' FAILED',
+                    prefix + 'test_dfds_d ... ERROR',
+                    prefix + 'test_dfds_f ... SKIP: Required test \'test_dfds_e\' SKIPPED']
+        eq_(sorted(expected), sorted(lines))
+        assert lines.index(expected[1]) < lines.index(expected[3])
+        assert lines.index(expected[2]) < lines.index(expected[5])
+
+
+class TestIndexedDependencyTester(NoseDepPluginTester):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.index_dir, 'index.json')
+        self.args = ['-v', '--nosedep-index=' + self.index_file]
+        super(TestIndexedDependencyTester, self).setUp()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+        super(TestIndexedDependencyTester, self).tearDown()
+
+
+class TestIndexedOtherFile(TestIndexedDependencyTester):
+    suitepath = "test_scripts/index_test/index_dependent.py:test_idx_dep"
+
+    def runTest(self):
+        self.check(['test_scripts.index_test.index_base.test_idx_base ... ok',
+                    'test_scripts.index_test.index_dependent.test_idx_dep ... ok'])
+        assert os.path.isfile(self.index_file)
+
+
+class TestIndexedDirectory(TestIndexedDependencyTester):
+    suitepath = "test_scripts:test_dft_c"
+
+    def runTest(self):
+        self.check(['test_scripts.decorated_functional_tests.test_dft_b ... ok',
+                    'test_scripts.decorated_functional_tests.test_dft_c ... ok'])
+
+
+class TestDependencyIndex(unittest.TestCase):
+    def setUp(self):
+        self.index_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.index_dir, 'index.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.index_dir)
+
+    def test_closure_files(self):
+        index = nosedep.DependencyIndex(self.index_file).update('test_scripts')
+        index.save()
+        eq_([os.path.abspath('test_scripts/decorated_functional_tests.py')],
+            index.closure_files('test_dft_d', 'test_scripts'))
+        eq_({'test_dft_d', 'test_dft_a', 'test_dft_b'}, index.hard_closure('test_dft_d'))
+        eq_([], index.closure_files('test_missing', 'test_scripts'))
+
+    def test_reload(self):
+        nosedep.DependencyIndex(self.index_file).update('test_scripts').save()
+        index = nosedep.DependencyIndex(self.index_file).update('test_scripts')
+        self.assertFalse(index.changed)
+        eq_({'test_dfm_b', 'test_dfm_c'}, set(index.after['test_dfm_a']))
+
+    def write(self, name, source):
+        file_name = os.path.join(self.index_dir, name)
+        if not os.path.isdir(os.path.dirname(file_name)):
+            os.makedirs(os.path.dirname(file_name))
+        with open(file_name, 'w') as f:
+            f.write(source)
+        return file_name
+
+    def test_same_module(self):
+        source = ("@depends(after=test_base)\ndef {}():\n    pass\n\n"
+                  "def test_base():\n    pass\n")
+        first = self.write('test_first.py', source.format('test_one'))
+        self.write('test_second.py', source.format('test_two'))
+        index = nosedep.DependencyIndex(self.index_file).update(self.index_dir)
+        eq_([first], index.closure_files('test_one', self.index_dir))
+
+    def test_skip_directories(self):
+        source = 'def test_x():\n    pass\n'
+        tests = self.write('test_dir/test_x.py', source)
+        package = self.write('pkg/test_x.py', source)
+        init = self.write('pkg/__init__.py', '')
+        self.write('venv/lib/test_x.py', source)
+        self.write('build/lib/pkg/test_x.py', source)
+        index = nosedep.DependencyIndex(self.index_file).update(self.index_dir)
+        eq_({init, package, tests}, set(index.files))
+
+
+class TestHasClass(unittest.TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.mkdtemp()
+        self.source = os.path.join(self.source_dir, 'has_class_module.py')
+        with open(self.source, 'w') as f:
+            f.write('raise RuntimeError("Imported")\n\n'
+                    'class TestFound(object):\n'
+                    '    def test_method(self):\n'
+                    '        pass\n\n'
+                    'if True:\n'
+                    '    class TestConditional(object):\n'
+                    '        pass\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.source_dir)
+
+    def test_has_class_does_not_import(self):
+        self.assertTrue(nosedep.has_class(self.source, 'TestFound'))
+        self.assertTrue(nosedep.has_class(self.source, 'TestConditional'))
+        self.assertFalse(nosedep.has_class(self.source, 'test_method'))
+        self.assertFalse(nosedep.has_class(self.source, 'TestFound.test_method'))
+
+
+class TestDepLoaderNames(unittest.TestCase):
+    def test_file_loaded_once(self):
+        loader = DepLoader(Config())
+        suite = loader.loadTestsFromNames(['test_scripts/decorated_functional_tests.py:test_dft_a',
+                                           'test_scripts/decorated_functional_tests.py:test_dft_c'])
+        eq_(['test_dft_a', 'test_dft_c'], loader.tests)
+        eq_(1, len(list(suite)))
+
+
+class TestHardClosure(unittest.TestCase):
+    def setUp(self):
+        self.registered = []
+
+    def tearDown(self):
+        for name in self.registered:
+            nosedep.dependencies.pop(name, None)
+        nosedep.invalidate_plan()
+
+    def add(self, name, after):
+        nosedep.dependencies[name].update(after)
+        self.registered.append(name)
+
+    def test_wide_diamonds(self):
+        # 30 layers of 50 tests each depending on every test in the layer
+        # below gives 50**30 paths from the top to the bottom
+        layers = [['closure_root']] + [['closure_{}_{}'.format(layer, i) for i in range(50)]
+                                       for layer in range(30)]
+        for below, above in zip(layers, layers[1:]):
+            for name in above:
+                self.add(name, below)
+        nosedep.invalidate_plan()
+        closure = nosedep.hard_closure(layers[-1])
+        eq_(1 + 30 * 50, len(closure))
+        self.assertIs(closure, nosedep.hard_closure(reversed(layers[-1])))
+
+    def test_deep_chain(self):
+        chain = ['closure_chain_{}'.format(i) for i in range(10000)]
+        for below, above in zip(chain, chain[1:]):
+            self.add(above, [below])
+        nosedep.invalidate_plan()
+        eq_(set(chain), nosedep.hard_closure([chain[-1]]))
+
+    def test_invalidated_by_depends(self):
+        self.registered.append('run_test_closure_b')
+        eq_({'run_test_closure_b'}, nosedep.hard_closure(['run_test_closure_b']))
+
+        @depends(after='run_test_closure_a')
+        def run_test_closure_b():
+            pass
+
+        eq_({'run_test_closure_a', 'run_test_closure_b'},
+            nosedep.hard_closure(['run_test_closure_b']))
+
+
+class TestDependencyGraph(unittest.TestCase):
+    def setUp(self):
+        self.graph = nosedep.DependencyGraph()
+        self.dependencies = nosedep.Edges(self.graph, nosedep.HARD)
+        self.soft_dependencies = nosedep.Edges(self.graph, nosedep.SOFT)
+        self.priorities = nosedep.Priorities(self.graph)
+
+    def levels(self):
+        return [sorted(self.graph.names[i] for i in level) for level in self.graph.levels()]
+
+    def test_views(self):
+        self.dependencies['b'].update(['a', 'a'])
+        self.soft_dependencies['c'].add('b')
+        self.priorities['c'] = 3
+        eq_({'a'}, self.dependencies['b'])
+        eq_(['b'], list(self.dependencies))
+        self.assertNotIn('a', self.dependencies)
+        eq_((), self.dependencies.get('a', ()))
+        eq_(3, self.priorities['c'])
+        eq_(nosedep.default_priority, self.priorities['a'])
+        eq_([['a'], ['b'], ['c']], self.levels())
+        eq_({'a'}, self.dependencies.pop('b'))
+        eq_(None, self.dependencies.pop('b', None))
+        eq_([['b'], ['c']], self.levels())
+
+    def test_members_only_while_adding(self):
+        self.dependencies['b'].update(['a', 'c'])
+        self.levels()
+        # Each edge is only stored in the arrays once the plan is made
+        eq_({}, self.graph.members)
+        self.assertIn('a', self.dependencies['b'])
+        self.dependencies['b'].add('a')
+        self.dependencies['b'].discard('c')
+        eq_(['a'], list(self.dependencies['b']))
+        eq_([['a'], ['b']], self.levels())
+
+    def test_merge_dicts(self):
+        self.soft_dependencies['b'].add('c')
+        self.dependencies['b'].add('a')
+        eq_({'b': {'a', 'c'}}, nosedep.merge_dicts(self.dependencies, self.soft_dependencies))
+
+    def test_levels_sorted_by_priority(self):
+        self.dependencies['x'].update(['c', 'b', 'a'])
+        self.priorities['c'] = 1
+        eq_([['c', 'a', 'b'], ['x']], list(self.graph.sorted_levels()))
+
+    def test_deep_chain(self):
+        chain = ['graph_chain_{}'.format(i) for i in range(10000)]
+        for below, above in zip(chain, chain[1:]):
+            self.dependencies[above].add(below)
+        eq_([[name] for name in chain], self.levels())
+
+    def test_self_dependency_ignored(self):
+        self.dependencies['a'].update(['a', 'b'])
+        eq_([['b'], ['a']], self.levels())
+
+    def test_cycle(self):
+        self.dependencies['a'].add('root')
+        self.dependencies['b'].add('a')
+        self.soft_dependencies['a'].add('b')
+        with self.assertRaises(nosedep.CircularDependencyError) as cm:
+            self.levels()
+        eq_({'a': {'b'}, 'b': {'a'}}, cm.exception.data)
+
+    def test_numpy_levels(self):
+        if nosedep.numpy is None:
+            raise SkipTest('NumPy is not installed')
+        for i in range(1, 2000):
+            self.dependencies['t{}'.format(i)].update('t{}'.format(j)
+                                                      for j in (i // 2, i // 3) if j)
+        expected = self.levels()
+        threshold = nosedep.numpy_threshold
+        nosedep.numpy_threshold = 0
+        try:
+            eq_(expected, self.levels())
+        finally:
+            nosedep.numpy_threshold = threshold
+
+    def test_numpy_cycle(self):
+        if nosedep.numpy is None:
+            raise SkipTest('NumPy is not installed')
+        # More active tests than an int8 count can hold
+        for i in range(1, 300):
+            self.dependencies['t{}'.format(i)].add('t{}'.format(i - 1))
+        self.dependencies['a'].add('b')
+        self.dependencies['b'].add('a')
+        threshold = nosedep.numpy_threshold
+        nosedep.numpy_threshold = 0
+        try:
+            with self.assertRaises(nosedep.CircularDependencyError) as cm:
+                self.levels()
+        finally:
+            nosedep.numpy_threshold = threshold
+        eq_({'a': {'b'}, 'b': {'a'}}, cm.exception.data)
+
+
+class TestHeapScheduler(unittest.TestCase):
+    def setUp(self):
+        self.graph = nosedep.DependencyGraph()
+        self.dependencies = nosedep.Edges(self.graph, nosedep.HARD)
+        self.priorities = nosedep.Priorities(self.graph)
+
+    def test_order(self):
+        self.dependencies['b'].add('a')
+        self.dependencies['x'].add('y')
+        self.priorities['a'] = 1
+        self.priorities['b'] = 1
+        self.priorities['y'] = 2
+        eq_([['a', 'y'], ['b', 'x']], list(self.graph.sorted_levels()))
+        eq_(['a', 'b', 'y', 'x'], list(nosedep.HeapScheduler(self.graph)))
+
+    def test_streaming(self):
+        self.dependencies['c'].update(['a', 'b'])
+        scheduler = nosedep.HeapScheduler(self.graph)
+        eq_(['a', 'b'], scheduler.ready())
+        eq_('a', scheduler.pop())
+        eq_('b', scheduler.pop())
+        eq_(None, scheduler.pop())
+        scheduler.done('b')
+        eq_([], scheduler.ready())
+        scheduler.done('a')
+        eq_('c', scheduler.pop())
+
+    def test_deep_chain(self):
+        chain = ['heap_chain_{}'.format(i) for i in range(10000)]
+        for below, above in zip(chain, chain[1:]):
+            self.dependencies[above].add(below)
+        eq_(chain, list(nosedep.HeapScheduler(self.graph)))
+
+    def test_cycle(self):
+        self.dependencies['a'].add('b')
+        self.dependencies['b'].add('a')
+        self.dependencies['c'].add('root')
+        with self.assertRaises(nosedep.CircularDependencyError) as cm:
+            list(nosedep.HeapScheduler(self.graph))
+        eq_({'a': {'b'}, 'b': {'a'}}, cm.exception.data)
+
+    def test_toposort_levels(self):
+        eq_([{1, 2, 4}, {3}], nosedep.toposort_levels({1: set(), 2: {2}, 3: {1, 2}, 4: set()}))
+
+
 class TestDecoratedFunctionalPriority(NoseDepPluginTester):
     suitepath = "test_scripts/decorated_functional_priority.py:"
 
@@ -328,6 +1470,23 @@ class TestDecoratedFunctionalPriority(NoseDepPluginTester):
                     'test_scripts.decorated_functional_priority.test_dfp_c ... ok'])
 
 
+class TestDecoratedFunctionalPriorityHeap(NoseDepPluginTester):
+    args = ['-v', '--nosedep-order=heap']
+    suitepath = "test_scripts/decorated_functional_priority.py:"
+
+    def runTest(self):
+        # g, h and i only wait for a, not for f which is in the same level as a
+        self.check(['test_scripts.decorated_functional_priority.test_dfp_b ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_a ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_g ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_h ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_i ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_f ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_d ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_e ... ok',
+                    'test_scripts.decorated_functional_priority.test_dfp_c ... ok'])
+
+
 class TestDecoratedMethodPriority(NoseDepPluginTester):
     suitepath = "test_scripts/decorated_method_priority.py:"
 
@@ -391,6 +1550,162 @@ class TestDependsSelf(NoseDepPluginTester):
             return [TC('run_test_self_dep')]
 
 
+daemon_tests = """from nosedep import depends
+
+
+@depends(after='test_dmn_{first}')
+def test_dmn_{second}():
+    pass
+
+
+def test_dmn_{first}():
+    {body}
+"""
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'daemon_tests.py')
+        self.daemon = nosedep_server.Daemon(os.path.join(self.directory, 'socket'), self.directory)
+        self.stamp = 1000000000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        sys.modules.pop('daemon_tests', None)
+        nosedep.declarations.pop('daemon_tests', None)
+        for name in ('test_dmn_a', 'test_dmn_b'):
+            nosedep.dependencies.pop(name, None)
+        nosedep.invalidate_plan()
+
+    def write(self, first, second, body):
+        self.write_source(daemon_tests.format(first=first, second=second, body=body))
+
+    def write_source(self, source):
+        with open(self.file_name, 'w') as f:
+            f.write(source)
+        # Also a change within the resolution of the file system
+        self.stamp += 10
+        os.utime(self.file_name, (self.stamp, self.stamp))
+
+    def run_daemon(self, name=None):
+        messages = []
+        self.daemon.stdout.send = self.daemon.stderr.send = messages.append
+        target = self.file_name + (':' + name if name else '')
+        try:
+            code = self.daemon.run(['-v', '--with-nosedep', target], {})
+        finally:
+            self.daemon.stdout.send = self.daemon.stderr.send = None
+        lines = ''.join(m.get('stderr', '') for m in messages).splitlines()
+        return code, [line for line in lines if ' ... ' in line]
+
+    def test_reload(self):
+        self.write('a', 'b', 'assert False')
+        eq_((1, ['daemon_tests.test_dmn_a ... FAIL',
+                 "daemon_tests.test_dmn_b ... SKIP: Required test 'test_dmn_a' FAILED"]),
+            self.run_daemon())
+        plan = get_plan()
+        module = sys.modules['daemon_tests']
+        eq_(1, self.run_daemon()[0])
+        # Nothing changed, nothing is loaded or planned again
+        self.assertIs(module, sys.modules['daemon_tests'])
+        self.assertIs(plan, get_plan())
+
+        self.write('a', 'b', 'pass')
+        eq_((0, ['daemon_tests.test_dmn_a ... ok', 'daemon_tests.test_dmn_b ... ok']),
+            self.run_daemon())
+        self.assertIsNot(module, sys.modules['daemon_tests'])
+        # The declarations are the same, so is the plan
+        self.assertIs(plan, get_plan())
+
+        self.write('b', 'a', 'pass')
+        eq_((0, ['daemon_tests.test_dmn_b ... ok', 'daemon_tests.test_dmn_a ... ok']),
+            self.run_daemon())
+        ok_('test_dmn_b' not in nosedep.dependencies)
+
+    def test_changed_while_running(self):
+        self.write('a', 'b', 'pass')
+        # Changed after the run started, maybe after it was imported
+        os.utime(self.file_name, None)
+        self.run_daemon()
+        module = sys.modules['daemon_tests']
+        self.run_daemon()
+        self.assertIsNot(module, sys.modules['daemon_tests'])
+
+    def test_class_replaced(self):
+        self.write_source('class TestDmn(object):\n'
+                          '    def test_dmn_method(self):\n'
+                          '        pass\n')
+        eq_((0, ['daemon_tests.TestDmn.test_dmn_method ... ok']), self.run_daemon('TestDmn'))
+        # No longer a class, only the test of that name runs
+        self.write_source('def TestDmn():\n    pass\n\n\n'
+                          'def test_dmn_other():\n    pass\n')
+        eq_((0, ['daemon_tests.TestDmn ... ok']), self.run_daemon('TestDmn'))
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class TestDaemonSocket(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'daemon_tests.py'), 'w') as f:
+            f.write(daemon_tests.format(first='a', second='b', body='assert False'))
+        self.socket_file = os.path.join(self.directory, 'socket')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(nosedep.__file__)))
+        self.daemon = subprocess.Popen([sys.executable, '-m', 'nosedep_daemon', '--socket',
+                                        self.socket_file, 'serve'], cwd=self.directory, env=env)
+        # The socket file exists a moment before the daemon listens
+        for _ in range(200):
+            client = nosedep_daemon.connect(self.socket_file)
+            if client is not None:
+                client.close()
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        nosedep_daemon.main(['--socket', self.socket_file, 'stop'])
+        self.daemon.wait()
+        shutil.rmtree(self.directory)
+
+    def request(self, cwd):
+        out, err = StringIO(), StringIO()
+        code = nosedep_daemon.request(nosedep_daemon.connect(self.socket_file),
+                                      {'argv': ['-v', '--with-nosedep', 'daemon_tests.py'],
+                                       'cwd': cwd, 'env': {}}, out, err)
+        return code, err.getvalue()
+
+    def test_run(self):
+        code, output = self.request(self.directory)
+        eq_(1, code)
+        assert_in("daemon_tests.test_dmn_a ... FAIL\n"
+                  "daemon_tests.test_dmn_b ... SKIP: Required test 'test_dmn_a' FAILED\n",
+                  output)
+        assert_in('FAILED (SKIP=1, failures=1)', output)
+
+    def test_other_directory(self):
+        eq_((2, 'nosedep daemon serves {}, not {}\n'.format(
+            os.path.realpath(self.directory), os.getcwd())), self.request(os.getcwd()))
+
+
+class TestPlanCache(unittest.TestCase):
+    def tearDown(self):
+        nosedep.dependencies.pop('run_test_plan_cache_b', None)
+        nosedep.invalidate_plan()
+
+    def test_plan_cached_until_depends(self):
+        plan = get_plan()
+        self.assertIs(plan, get_plan())
+
+        @depends(after='run_test_plan_cache_a')
+        def run_test_plan_cache_b():
+            pass
+
+        self.assertIsNot(plan, get_plan())
+        order = get_plan().order
+        self.assertLess(order.index('run_test_plan_cache_a'), order.index('run_test_plan_cache_b'))
+        self.assertEqual(get_plan().position['run_test_plan_cache_b'],
+                         order.index('run_test_plan_cache_b'))
+
+
 if __name__ == '__main__':
     unittest.main()
 